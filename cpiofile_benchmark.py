@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""
+Reproducible benchmarks for xcp.cpiofile
+
+Generates synthetic trees and archives from a fixed random seed:
+
+- tiny:      many small files in nested directories
+- huge:      a few large files of partly compressible data
+- hardlinks: groups of hard links to the same files
+
+Each tree is archived uncompressed and in the gz, bz2 and xz compressions,
+and these operations are timed (best of --repeat runs):
+
+- add:         CpioFile.add() of the tree ("w:<comp>")
+- getmembers:  CpioFile.getmembers() in file mode ("r:<comp>")
+- iterate:     iterating over the members in stream mode ("r|<comp>")
+- extractfile: reading randomly chosen members using extractfile()
+- extractall:  extractall() in file mode and in stream mode
+- stream_write_512, stream_write_1m, stream_read_512, stream_read_1m:
+               writing and reading the archive through the _Stream class of
+               the stream modes in pieces of 512 bytes and of 1 MiB
+
+The results are written as JSON to --output, which --compare reads to print
+the change against a baseline run (e.g. of another version) and to return
+exit status 1 if an operation became slower by more than --threshold percent.
+
+Usage:
+    python3 cpiofile_benchmark.py --output new.json [--compare old.json]
+
+To benchmark another version, e.g. the baseline, pass the path of its
+checkout using --xcp: python3 cpiofile_benchmark.py --xcp ../old -o old.json
+"""
+
+import argparse
+import functools
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+CpioFile = None  # type: Any # imported by main() from the checkout to benchmark
+_Stream = None  # type: Any # imported by main() from the checkout to benchmark
+COMPRESSIONS = ["", "gz", "bz2", "xz"]
+BUFSIZE = 20 * 512  # the default bufsize of CpioFile.open()
+SIZES = {"512": 512, "1m": 1024 * 1024}
+
+
+def make_data(rng: random.Random, size: int) -> bytes:
+    """Return size bytes of data which compress about like binaries do"""
+    words = [b"%x" % rng.getrandbits(32) for _ in range(256)]
+    data = bytearray()
+    while len(data) < size:
+        if rng.random() < 0.5:
+            data += b" ".join(rng.choice(words) for _ in range(64))
+        else:
+            data += rng.getrandbits(8 * 512).to_bytes(512, "little")
+    return bytes(data[:size])
+
+
+def make_tiny(root: str, rng: random.Random, scale: float) -> None:
+    """Create many small files in nested directories"""
+    for i in range(int(5000 * scale)):
+        directory = os.path.join(root, "d%02d" % (i % 50), "s%d" % (i % 7))
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, "f%05d" % i), "wb") as f:
+            f.write(make_data(rng, rng.randrange(0, 1024)))
+
+
+def make_huge(root: str, rng: random.Random, scale: float) -> None:
+    """Create a few large files"""
+    for i in range(3):
+        with open(os.path.join(root, "huge%d" % i), "wb") as f:
+            f.write(make_data(rng, int(8 * 1024 * 1024 * scale)))
+
+
+def make_hardlinks(root: str, rng: random.Random, scale: float) -> None:
+    """Create groups of hard links to files"""
+    for i in range(int(500 * scale)):
+        name = os.path.join(root, "file%04d" % i)
+        with open(name, "wb") as f:
+            f.write(make_data(rng, rng.randrange(1024, 16384)))
+        for j in range(1, 8):
+            os.link(name, os.path.join(root, "file%04d.link%d" % (i, j)))
+
+
+DATASETS = {"tiny": make_tiny, "huge": make_huge, "hardlinks": make_hardlinks}
+
+
+def best_of(repeat: int, func: Callable[[], Any], setup: Optional[Callable[[], Any]] = None) -> float:
+    """Return the shortest time of repeat calls of func, calling setup before each"""
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def add_tree(path: str, mode: str, tree: str) -> None:
+    archive = CpioFile.open(path, mode)
+    archive.add(tree, ".")
+    archive.close()
+
+
+def getmembers(path: str, mode: str) -> List[Any]:
+    archive = CpioFile.open(path, mode)
+    members = archive.getmembers()  # type: List[Any]
+    archive.close()
+    return members
+
+
+def iterate(path: str, mode: str) -> None:
+    archive = CpioFile.open(path, mode)
+    for _ in archive:
+        pass
+    archive.close()
+
+
+def extractfile(path: str, mode: str, names: List[str]) -> None:
+    archive = CpioFile.open(path, mode)
+    for name in names:
+        fileobj = archive.extractfile(name)
+        assert fileobj
+        fileobj.read()
+    archive.close()
+
+
+def stream_write(data: bytes, comp: str, size: int, bufsize: int = BUFSIZE) -> bytes:
+    """Write data to a _Stream in pieces of size bytes and return the written stream"""
+    output = io.BytesIO()
+    stream = _Stream(None, "w", comp or "cpio", output, bufsize)
+    for pos in range(0, len(data), size):
+        stream.write(data[pos:pos + size])
+    stream.close()
+    return output.getvalue()
+
+
+def stream_read(data: bytes, comp: str, size: int, bufsize: int = BUFSIZE) -> None:
+    """Read the stream data from a _Stream in pieces of size bytes"""
+    stream = _Stream(None, "r", comp or "cpio", io.BytesIO(data), bufsize)
+    while stream.read(size):
+        pass
+    stream.close()
+
+
+def extractall(path: str, mode: str, target: str) -> None:
+    archive = CpioFile.open(path, mode)
+    archive.extractall(target)
+    archive.close()
+
+
+def run_dataset(dataset: str, workdir: str, args: argparse.Namespace) -> List[Dict[str, Any]]:
+    """Create the tree of dataset and run the benchmarks on its archives"""
+    rng = random.Random("%s-%d" % (dataset, args.seed))
+    tree = os.path.join(workdir, dataset)
+    os.mkdir(tree)
+    DATASETS[dataset](tree, rng, args.scale)
+    target = os.path.join(workdir, "extracted")
+
+    def clean() -> None:
+        shutil.rmtree(target, ignore_errors=True)
+
+    # The uncompressed archive, which the stream_write benchmarks write:
+    archive = os.path.join(workdir, "%s.raw.cpio" % dataset)
+    add_tree(archive, "w:", tree)
+    with open(archive, "rb") as f:
+        raw = f.read()
+    os.unlink(archive)
+
+    results = []
+    for comp in args.compressions:
+        archive = os.path.join(workdir, "%s.cpio%s" % (dataset, "." + comp if comp else ""))
+        add_tree(archive, "w:" + comp, tree)
+        with open(archive, "rb") as f:
+            data = f.read()
+        names = [m.name for m in getmembers(archive, "r:" + comp) if m.isreg() and m.size]
+        names = random.Random(args.seed).sample(names, min(len(names), 20))
+
+        benchmarks = {
+            "add": lambda: add_tree(archive + ".new", "w:" + comp, tree),
+            "getmembers": lambda: getmembers(archive, "r:" + comp),
+            "iterate": lambda: iterate(archive, "r|" + comp),
+            "extractfile": lambda: extractfile(archive, "r:" + comp, names),
+            "extractall": lambda: extractall(archive, "r:" + comp, target),
+            "extractall_stream": lambda: extractall(archive, "r|" + comp, target),
+        }  # type: Dict[str, Callable[[], Any]]
+        for label, size in SIZES.items():
+            benchmarks["stream_write_" + label] = functools.partial(stream_write, raw, comp, size)
+            benchmarks["stream_read_" + label] = functools.partial(stream_read, data, comp, size)
+        for name, func in benchmarks.items():
+            if args.only and name not in args.only:
+                continue
+            seconds = best_of(args.repeat, func, clean)
+            result = {
+                "dataset": dataset,
+                "compression": comp or "none",
+                "benchmark": name,
+                "seconds": round(seconds, 6),
+                "archive_size": os.path.getsize(archive),
+            }
+            print("%-10s %-5s %-18s %10.4fs" % (dataset, result["compression"], name, seconds))
+            results.append(result)
+        clean()
+        os.unlink(archive)
+        if os.path.exists(archive + ".new"):
+            os.unlink(archive + ".new")
+    shutil.rmtree(tree)
+    return results
+
+
+def version(path: str) -> str:
+    """Return the git description of the version checked out at path, if available"""
+    try:
+        return subprocess.check_output(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=path,
+            stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def key(result: Dict[str, Any]) -> str:
+    return "%s/%s/%s" % (result["dataset"], result["compression"], result["benchmark"])
+
+
+def compare(results: List[Dict[str, Any]], baseline_path: str, threshold: float) -> int:
+    """Print the change of each result against the baseline, return the number of regressions"""
+    with open(baseline_path) as f:
+        baseline = dict((key(r), r) for r in json.load(f)["results"])
+    regressions = 0
+    print("\n%-36s %10s %10s %8s" % ("benchmark", "baseline", "current", "change"))
+    for result in results:
+        old = baseline.get(key(result))
+        if not old or not old["seconds"]:
+            continue
+        change = (result["seconds"] / old["seconds"] - 1) * 100
+        flag = ""
+        if change > threshold:
+            regressions += 1
+            flag = "  REGRESSION"
+        print("%-36s %9.4fs %9.4fs %+7.1f%%%s" % (
+            key(result), old["seconds"], result["seconds"], change, flag))
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--output", "-o", help="write the results as JSON to this file")
+    parser.add_argument("--compare", "-c", help="compare with the results in this JSON file")
+    parser.add_argument("--threshold", type=float, default=10.0,
+                        help="slowdown in percent reported as regression (default: 10)")
+    parser.add_argument("--repeat", "-r", type=int, default=3,
+                        help="number of runs of each benchmark, the best counts (default: 3)")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="multiply the number and size of the files (default: 1)")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the generated data")
+    parser.add_argument("--datasets", nargs="+", choices=list(DATASETS), default=list(DATASETS))
+    parser.add_argument("--compressions", nargs="+", choices=COMPRESSIONS,
+                        default=COMPRESSIONS, metavar="{'',gz,bz2,xz}")
+    parser.add_argument("--only", nargs="+", help="run only these benchmarks")
+    parser.add_argument("--xcp", default=os.path.dirname(os.path.abspath(__file__)),
+                        help="the checkout of python-libs to benchmark (default: this one)")
+    args = parser.parse_args(argv)
+
+    global CpioFile, _Stream  # pylint: disable=global-statement
+    sys.path.insert(0, os.path.abspath(args.xcp))
+    from xcp.cpiofile import CpioFile, _Stream  # pylint: disable=import-outside-toplevel
+
+    results = []  # type: List[Dict[str, Any]]
+    workdir = tempfile.mkdtemp(prefix="cpiofile-benchmark-")
+    try:
+        for dataset in args.datasets:
+            results.extend(run_dataset(dataset, workdir, args))
+    finally:
+        shutil.rmtree(workdir)
+
+    if args.output:
+        report = {
+            "version": version(args.xcp),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "settings": {"repeat": args.repeat, "scale": args.scale, "seed": args.seed},
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1)
+    if args.compare:
+        return 1 if compare(results, args.compare, args.threshold) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -153,12 +153,25 @@ class TestCpio(unittest.TestCase):
         self.doArchive('archive.cpio.xz', 'xz')
 
     def test_cover_xzopen_pass_fileobj(self):
-        """Cover CpioFile.xzopen() not supporting receiving a fileobj argument"""
+        """Cover CpioFile.xzopen() receiving a fileobj argument (not supported on Python 2)"""
         class MockCpioFile(CpioFile):
-            def __init__(self):  # pylint: disable=super-init-not-called
-                pass
-        with self.assertRaises(xcp.cpiofile.CompressionError):
-            MockCpioFile.xzopen(name="", mode="r", fileobj=lzma.LZMAFile("/dev/null"))
+            def __init__(self, *args):  # pylint: disable=super-init-not-called
+                self.args = args
+        if sys.version_info < (3, 0):
+            with self.assertRaises(xcp.cpiofile.CompressionError):
+                MockCpioFile.xzopen(name="", mode="r", fileobj=lzma.LZMAFile("/dev/null"))
+        else:
+            arc = MockCpioFile.xzopen(name="", mode="r", fileobj=lzma.LZMAFile("/dev/null"))
+            self.assertIsInstance(cast(MockCpioFile, arc).args[2], lzma.LZMAFile)
+
+    def test_xzopen_pass_fileobj(self):
+        """Cover CpioFile.xzopen() receiving a fileobj argument"""
+        if not self.doXZ:
+            raise unittest.SkipTest("lzma package or xz tool not available")
+        with open("archive.cpio.xz", "rb") as fileobj:
+            arc = CpioFile.xzopen(name="archive.cpio.xz", mode="r", fileobj=fileobj)
+            self.assertEqual(arc.getmember("archive/data").size, 10491)
+            arc.close()
     # CpioFileCompat testing
 
     def archiveExtractCompat(self, fn, comp):
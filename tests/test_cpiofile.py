@@ -5,15 +5,19 @@ types, opening the archive as stream and as file, using pyfakefs as filesystem w
 ever touching any real real file. pyfakefs was developed by Google and is in wide use.
 https://pytest-pyfakefs.readthedocs.io/en/latest/intro.html
 """
+import errno
+import gzip
 import io
 import os
+import pathlib
 import sys
-from typing import cast
+from typing import IO, Any, cast
 
 import pytest
 from pyfakefs.fake_filesystem import FakeFileOpen, FakeFilesystem
 
-from xcp.cpiofile import CpioFile, StreamError
+import xcp.cpiofile
+from xcp.cpiofile import INDEX_SUFFIX, CpioFile, CpioInfo, ExFileObject, StreamError
 
 binary_data = b"\x00\x1b\x5b\x95\xb1\xb2\xb3\xb4\xb5\xb6\xb7\xb8\xb9\xcc\xdd\xee\xff"
 
@@ -162,3 +166,864 @@ def pyfakefs_verify_filesystem(fs):
         assert contents.read() == binary_data
     with FakeFileOpen(fs)("dir2/file_2", "rb") as contents:
         assert contents.read() == binary_data
+
+
+def create_archive(mode, members, name=None, **kwargs):
+    # type: (str, dict[str, bytes], str | None, Any) -> bytes
+    """
+    Write an archive of regular files named by the keys of `members` in `mode`
+    to the file `name` or in memory and return the bytes of the archive.
+    """
+    cpiofile = None if name else io.BytesIO()
+    archive = CpioFile.open(name, mode, cpiofile, **kwargs)
+    for member, data in members.items():
+        cpioinfo = CpioInfo(member)
+        cpioinfo.size = len(data)
+        archive.addfile(cpioinfo, io.BytesIO(data))
+    archive.close()
+    if cpiofile:
+        return cpiofile.getvalue()
+    with open(cast(str, name), "rb") as archive_file:
+        return archive_file.read()
+
+
+def test_getmember_last_occurrence():
+    # type: () -> None
+    """getmember() returns the last member of a name, also via the name index"""
+    cpiofile = io.BytesIO()
+    archive = CpioFile.open(fileobj=cpiofile, mode="w|")
+    for data in (b"first", b"second"):
+        cpioinfo = CpioInfo("duplicate")
+        cpioinfo.size = len(data)
+        archive.addfile(cpioinfo, io.BytesIO(data))
+    assert archive.getmember("duplicate").size == len(b"second")
+    archive.close()
+
+    cpiofile.seek(0)
+    archive = CpioFile.open(fileobj=cpiofile, mode="r:")
+    member = archive.getmember("duplicate")
+    assert member is archive.getmembers()[-1]
+    assert cast(ExFileObject, archive.extractfile(member)).read() == b"second"
+    assert archive.getmember(b"duplicate") is member
+    with pytest.raises(KeyError):
+        archive.getmember("missing")
+    archive.close()
+
+
+def test_xz_roundtrip(tmp_path):
+    # type: (pathlib.Path) -> None
+    """Write and read an archive in mode "w:xz", passing the index keyword through xzopen()"""
+    name = str(tmp_path / "archive.cpio.xz")
+    create_archive("w:xz", {"member": binary_data}, name, index=True)
+    assert os.path.exists(name + INDEX_SUFFIX)
+
+    archive = CpioFile.open(name, "r:xz", index=True)
+    assert archive.getnames() == ["member"]
+    assert cast(ExFileObject, archive.extractfile("member")).read() == binary_data
+    archive.close()
+
+
+def test_member_index(tmp_path):
+    # type: (pathlib.Path) -> None
+    """Write an index with the archive and use it to open the archive without a header walk"""
+    name = str(tmp_path / "archive.cpio.gz")
+    create_archive("w:gz", {"first": b"first", "second": b"second", "third": b"third"},
+                   name, index=True)
+    assert os.path.exists(name + INDEX_SUFFIX)
+
+    archive = CpioFile.open(name, "r:gz", index=True)
+    assert archive._loaded  # pylint: disable=protected-access
+    assert archive.getnames() == ["first", "second", "third"]
+    assert cast(ExFileObject, archive.extractfile("third")).read() == b"third"
+    archive.close()
+
+    # An index that does not match the archive anymore is ignored:
+    os.utime(name, (0, 0))
+    archive = CpioFile.open(name, "r:gz", index=True)
+    assert not archive._loaded  # pylint: disable=protected-access
+    assert archive.getnames() == ["first", "second", "third"]
+    # and can be regenerated on demand:
+    archive.writeindex()
+    archive.close()
+    archive = CpioFile.open(name, "r:gz", index=True)
+    assert archive._loaded  # pylint: disable=protected-access
+    assert archive.getmember("second").offset_data == archive.members[1].offset_data
+    archive.close()
+
+
+def test_usemmap(tmp_path):
+    # type: (pathlib.Path) -> None
+    """Read an uncompressed archive mapped into memory: read() returns memoryviews"""
+    name = str(tmp_path / "archive.cpio")
+    create_archive("w:", {"config": b"key=value\nother=1\n", "data": binary_data}, name)
+
+    archive = CpioFile.open(name, "r:*", usemmap=True)
+    assert archive.getnames() == ["config", "data"]
+    fileobj = cast(ExFileObject, archive.extractfile("data"))
+    data = fileobj.read()
+    assert isinstance(data, memoryview)
+    assert data == binary_data
+    fileobj = cast(ExFileObject, archive.extractfile("config"))
+    assert fileobj.readline() == "key=value\n"
+    assert fileobj.read() == b"other=1\n"
+    archive.close()  # data still refers to the mapping, which must not fail
+    assert data == binary_data
+    del data
+
+    # Compressed archives cannot be mapped and are read normally:
+    with open(name, "rb") as uncompressed, gzip.open(name + ".gz", "wb") as compressed:
+        compressed.write(uncompressed.read())
+    archive = CpioFile.open(name + ".gz", "r:gz", usemmap=True)
+    assert cast(ExFileObject, archive.extractfile("data")).read() == binary_data
+    archive.close()
+
+
+def record_calls(monkeypatch, target, name):
+    # type: (pytest.MonkeyPatch, Any, str) -> list[tuple[Any, ...]]
+    """Wrap the function `name` of `target` to record the arguments of its calls"""
+    calls = []  # type: list[tuple[Any, ...]]
+    function = getattr(target, name)
+
+    def wrapper(*args):
+        # type: (Any) -> Any
+        calls.append(args)
+        return function(*args)
+
+    if isinstance(vars(target).get(name), staticmethod):
+        monkeypatch.setattr(target, name, staticmethod(wrapper))
+    else:
+        monkeypatch.setattr(target, name, wrapper)
+    return calls
+
+
+@pytest.mark.parametrize("method", ["copy_file_range", "sendfile", None])
+def test_makefile_kernel_copy(tmp_path, monkeypatch, method):
+    # type: (pathlib.Path, pytest.MonkeyPatch, str | None) -> None
+    """Extract regular files using each in-kernel copy method and the fallback"""
+    blob = os.urandom(300 * 1024 + 3)
+    name = str(tmp_path / "archive.cpio")
+    create_archive("w:", {"small": binary_data, "blob": blob}, name)
+
+    def unsupported(*_args):
+        raise OSError(errno.EXDEV, "not supported")
+
+    calls = record_calls(monkeypatch, os, method) if method else []
+    for other in ("copy_file_range", "sendfile"):
+        if other != method:
+            monkeypatch.setattr(os, other, unsupported, raising=False)
+    archive = CpioFile.open(name, "r:")
+    archive.extractall(str(tmp_path / "out"))
+    archive.close()
+    assert bool(calls) == bool(method)
+    assert (tmp_path / "out" / "blob").read_bytes() == blob
+    assert (tmp_path / "out" / "small").read_bytes() == binary_data
+
+
+def test_extractall_workers(tmp_path):
+    # type: (pathlib.Path) -> None
+    """Extract files, directories, hard links and symlinks in parallel"""
+    source = tmp_path / "source"
+    (source / "dir" / "subdir").mkdir(parents=True)
+    for i in range(20):
+        (source / "dir" / ("file%d" % i)).write_bytes(os.urandom(i * 4099))
+    (source / "dir" / "subdir" / "data").write_bytes(binary_data)
+    os.link(str(source / "dir" / "subdir" / "data"), str(source / "dir" / "hardlink"))
+    os.symlink("subdir/data", str(source / "dir" / "symlink"))
+    os.utime(str(source / "dir" / "subdir"), (0, 0))
+
+    name = str(tmp_path / "archive.cpio")
+    archive = CpioFile.open(name, "w:")
+    archive.add(str(source / "dir"), "dir")
+    archive.close()
+
+    archive = CpioFile.open(name, "r:")
+    archive.extractall(str(tmp_path / "out"), workers=4)
+    archive.close()
+    out = tmp_path / "out" / "dir"
+    for i in range(20):
+        filename = "file%d" % i
+        assert (out / filename).read_bytes() == (source / "dir" / filename).read_bytes()
+    assert (out / "hardlink").read_bytes() == binary_data
+    assert os.path.samefile(str(out / "hardlink"), str(out / "subdir" / "data"))
+    assert os.readlink(str(out / "symlink")) == "subdir/data"
+    assert os.stat(str(out / "subdir")).st_mtime == 0
+
+
+def test_parallel_gzip_writer(monkeypatch):
+    # type: (pytest.MonkeyPatch) -> None
+    """Write a multi-member gzip stream using threads and read it in all gzip modes"""
+    monkeypatch.setattr(xcp.cpiofile, "PGZ_BLOCKSIZE", 64 * 1024)
+    members = {"blob": os.urandom(200 * 1024), "text": b"compressible\n" * 30000}
+
+    uncompressed = create_archive("w|", members)
+    compressed = create_archive("w|pgz", members, threads=4, compresslevel=1)
+    assert compressed.count(b"\x1f\x8b\x08\x04") >= len(uncompressed) // (64 * 1024)
+    assert gzip.decompress(compressed) == uncompressed
+    assert gzip.decompress(create_archive("w|pgz", members, threads=1)) == uncompressed
+    # compresslevel=0 stores the data without compressing it:
+    for mode in ("w|gz", "w|pgz"):
+        stored = create_archive(mode, members, compresslevel=0)
+        assert len(stored) > len(uncompressed)
+        assert gzip.decompress(stored) == uncompressed
+
+    for mode in ("r|*", "r|gz", "r:gz"):
+        archive = CpioFile.open(fileobj=io.BytesIO(compressed), mode=mode)
+        for cpioinfo in archive:
+            data = cast(ExFileObject, archive.extractfile(cpioinfo)).read()
+            assert data == members[cpioinfo.name]
+        assert archive.getnames() == list(members)
+        archive.close()
+
+
+def test_parallel_gzip_reader(monkeypatch):
+    # type: (pytest.MonkeyPatch) -> None
+    """Decompress "pgz" members ahead in threads and fall back for other gzip members"""
+    monkeypatch.setattr(xcp.cpiofile, "PGZ_BLOCKSIZE", 16 * 1024)
+    members = {"blob": os.urandom(100 * 1024), "text": b"compressible\n" * 10000}
+    uncompressed = create_archive("w|", members)
+
+    blocked = b"".join(xcp.cpiofile._gzipmember(uncompressed[i:i + 8192], 6, 0)
+                       for i in range(0, 120 * 1024, 8192))
+    mixed = blocked + gzip.compress(uncompressed[120 * 1024:])
+    for compressed, parallel in ((mixed, True), (gzip.compress(uncompressed), False)):
+        archive = CpioFile.open(fileobj=io.BytesIO(compressed), mode="r|pgz", threads=3)
+        assert (cast(xcp.cpiofile._Stream, archive.fileobj).executor is not None) == parallel
+        for cpioinfo in archive:
+            data = cast(ExFileObject, archive.extractfile(cpioinfo)).read()
+            assert data == members[cpioinfo.name]
+        assert archive.getnames() == list(members)
+        archive.close()
+
+    # Corrupted members are detected:
+    corrupted = bytearray(mixed)
+    corrupted[100] ^= 0xFF
+    with pytest.raises(xcp.cpiofile.CompressionError):
+        CpioFile.open(fileobj=io.BytesIO(bytes(corrupted)), mode="r|pgz", threads=3)
+    with pytest.raises(xcp.cpiofile.CompressionError):
+        xcp.cpiofile._gunzipmember(b"\xff" * 16 + b"\0" * 8)  # Invalid deflate data
+
+
+@pytest.mark.parametrize("comptype", ["", "gz", "bz2", "xz"])
+def test_open_sniff(tmp_path, monkeypatch, comptype):
+    # type: (pathlib.Path, pytest.MonkeyPatch, str) -> None
+    """open("r") calls only the *open() method for the compression of the archive"""
+    members = {"data": binary_data}
+    data = create_archive("w:" + comptype, members)
+    path = tmp_path / "archive.cpio"
+    path.write_bytes(data)
+    called = []  # type: list[str]
+
+    def recorder(meth):
+        # type: (str) -> Any
+        func = getattr(CpioFile, meth).__func__
+
+        def opener(cls, *args, **kwargs):
+            # type: (type[CpioFile], Any, Any) -> CpioFile
+            called.append(meth)
+            return cast(CpioFile, func(cls, *args, **kwargs))
+        return classmethod(opener)
+
+    for meth in CpioFile.OPEN_METH.values():
+        monkeypatch.setattr(CpioFile, meth, recorder(meth))
+
+    for kwargs in ({"name": str(path)}, {"fileobj": io.BytesIO(data)}):
+        del called[:]
+        archive = CpioFile.open(mode="r", **kwargs)  # type: ignore[arg-type]
+        # The *open() methods of compressed archives call cpioopen():
+        assert called in ([CpioFile.OPEN_METH[comptype or "cpio"]],
+                          [CpioFile.OPEN_METH[comptype or "cpio"], "cpioopen"])
+        assert cast(ExFileObject, archive.extractfile("data")).read() == binary_data
+        archive.close()
+
+    with pytest.raises(xcp.cpiofile.ReadError):
+        CpioFile.open(fileobj=io.BytesIO(b"junk" + data), mode="r")
+
+
+@pytest.mark.parametrize("comptype", ["", "gz", "bz2", "xz"])
+def test_open_sniff_once(tmp_path, monkeypatch, comptype):
+    # type: (pathlib.Path, pytest.MonkeyPatch, str) -> None
+    """open("r") reads the archive from the file opened for the magic bytes"""
+    members = {"data": binary_data}
+    name = str(tmp_path / "archive.cpio")
+    create_archive("w:" + comptype, members, name)
+    opened = []  # type: list[IO[bytes]]
+
+    def open_and_remove(path, mode):
+        # type: (str, str) -> IO[bytes]
+        fileobj = open(path, mode)
+        os.unlink(path)  # Opening the archive again by name fails
+        opened.append(fileobj)
+        return fileobj
+
+    monkeypatch.setattr(xcp.cpiofile, "bltn_open", open_and_remove)
+    archive = CpioFile.open(name, "r")
+    assert cast(ExFileObject, archive.extractfile("data")).read() == binary_data
+    assert len(opened) == 1 and not opened[0].closed
+    archive.close()
+    assert opened[0].closed
+
+
+def test_xzopen_fileobj():
+    # type: () -> None
+    """xzopen() accepts a fileobj"""
+    members = {"data": binary_data}
+    archive = CpioFile.open(fileobj=io.BytesIO(create_archive("w:xz", members)), mode="r:xz")
+    assert cast(ExFileObject, archive.extractfile("data")).read() == binary_data
+    archive.close()
+
+
+@pytest.mark.parametrize("comptype", ["zst", "lz4", "xz"])
+def test_external_filters(tmp_path, comptype):
+    # type: (pathlib.Path, str) -> None
+    """Write and read archives using the external filter programs"""
+    if comptype not in xcp.cpiofile.available_filters():
+        pytest.skip("no %s program found" % comptype)
+    members = {"blob": os.urandom(100 * 1024), "data": binary_data}
+    kwargs = {"external": True}  # type: dict[str, Any]
+
+    # Stream modes with a fileobj, read back with compression detection:
+    compressed = create_archive("w|" + comptype, members, **kwargs)
+    archive = CpioFile.open(fileobj=io.BytesIO(compressed), mode="r|*", **kwargs)
+    for cpioinfo in archive:
+        data = cast(ExFileObject, archive.extractfile(cpioinfo)).read()
+        assert data == members[cpioinfo.name]
+    archive.close()
+
+    # File modes with named files, and random access by restarting the filter:
+    name = str(tmp_path / ("archive.cpio." + comptype))
+    create_archive("w:" + comptype, members, name, **kwargs)
+    archive = CpioFile.open(name, "r:*", **kwargs)
+    assert archive.getnames() == ["blob", "data"]
+    assert cast(ExFileObject, archive.extractfile("data")).read() == binary_data
+    assert cast(ExFileObject, archive.extractfile("blob")).read() == members["blob"]
+    archive.close()
+
+
+def test_member_table():
+    # type: () -> None
+    """CpioInfo has no __dict__ and CpioFile.getmembertable() lists members in arrays"""
+    members = {"first": b"1", "dir/second": binary_data, "third": b""}
+    data = create_archive("w|", members)
+    archive = CpioFile.open(fileobj=io.BytesIO(data), mode="r:")
+    table = archive.getmembertable()
+    assert len(table) == 3
+    assert table.name(1) == "dir/second"
+    assert table.index("third") == 2
+    assert table.index(b"first") == 0
+    with pytest.raises(KeyError):
+        table.index("dir")
+    _, _, offset_data, size, _ = table[1]
+    assert data[offset_data:offset_data + size] == binary_data
+    # The members were not kept, but can be loaded afterwards:
+    assert archive.getnames() == list(members)
+    member = archive.getmember("first")
+    assert member.buf is None
+    assert not hasattr(member, "__dict__")
+    assert table[0] == ("first", member.offset, member.offset_data, 1, member.mode)
+    archive.close()
+
+    class KeepHeaders(CpioFile):
+        keepheaders = True
+
+    archive = KeepHeaders.open(fileobj=io.BytesIO(data), mode="r|")
+    assert archive.getmember("first").buf == data[:xcp.cpiofile.HEADERSIZE_SVR4]
+    archive.close()
+
+
+@pytest.mark.parametrize("mode", ["r:", "r|"])
+def test_stream(mode):
+    # type: (str) -> None
+    """CpioFile.stream() yields the members with their data without keeping them"""
+    members = {"first": b"1", "dir/second": binary_data, "third": b""}
+    data = create_archive("w|", members)
+    archive = CpioFile.open(fileobj=io.BytesIO(data), mode=mode)
+    streamed = {}
+    for cpioinfo, fileobj in archive.stream():
+        assert fileobj is not None
+        streamed[cpioinfo.name] = fileobj.read()
+    assert streamed == members
+    # Only the first member, read when opening the archive, is kept:
+    assert len(archive.members) == 1
+    if mode == "r:":
+        assert archive.getnames() == list(members)
+    archive.close()
+
+
+@pytest.mark.parametrize("mode", ["r|gz", "r|", "r:"])
+def test_select(tmp_path, monkeypatch, mode):
+    # type: (pathlib.Path, pytest.MonkeyPatch, str) -> None
+    """Filters select members by their headers, the other data is skipped without copying it"""
+    members = {
+        "lib/modules/6.1/kernel/big.ko": os.urandom(1 << 20),
+        "lib/modules/6.1/modules.dep": b"kernel/big.ko:\n",
+        "lib/firmware/blob.bin": os.urandom(1 << 20),
+        "etc/modules.dep": b"other\n",
+    }
+    data = create_archive("w|" + mode[2:], members)
+    calls = record_calls(monkeypatch, xcp.cpiofile._Stream, "_consume")
+
+    archive = CpioFile.open(fileobj=io.BytesIO(data), mode=mode)
+    archive.extractall(str(tmp_path), include="/lib/modules/*/modules.dep")
+    archive.close()
+    assert (tmp_path / "lib/modules/6.1/modules.dep").read_bytes() == b"kernel/big.ko:\n"
+    assert not (tmp_path / "lib/modules/6.1/kernel/big.ko").exists()
+    assert not (tmp_path / "etc").exists()
+    assert sum(size for _, size in calls) < 1 << 20  # big.ko and blob.bin were not copied
+
+    archive = CpioFile.open(fileobj=io.BytesIO(data), mode=mode)
+    names = [m.name for m in archive.select(["lib/*"], exclude=lambda m: m.size > 1000)]
+    assert names == ["lib/modules/6.1/modules.dep"]
+    archive.close()
+
+
+def test_gzip_checkpoints(tmp_path, monkeypatch):
+    # type: (pathlib.Path, pytest.MonkeyPatch) -> None
+    """"r:gz" with checkpoints reads members in any order and keeps member starts in the index"""
+    members = dict(("member%d" % i, os.urandom(50000 + i)) for i in range(8))
+    data = create_archive("w:gz", members)
+    archive = CpioFile.open(fileobj=io.BytesIO(data), mode="r:gz", checkpoints=65536)
+    assert isinstance(archive.fileobj, xcp.cpiofile._GzipIndexProxy)
+    for name in reversed(list(members)):
+        assert cast(ExFileObject, archive.extractfile(name)).read() == members[name]
+    assert len(archive.fileobj.points) > 3
+    # Only the start and the end of the single gzip member can be persisted:
+    assert [rawpos for _, rawpos in archive.fileobj.getpoints()] == [0, len(data)]
+    archive.close()
+    with pytest.raises(xcp.cpiofile.ReadError):
+        CpioFile.open(fileobj=io.BytesIO(b"not gzip" * 20), mode="r:gz", checkpoints=True)
+    # cpioopen() ignores checkpoints, when "r:*" finds an uncompressed archive:
+    CpioFile.open(fileobj=io.BytesIO(create_archive("w:", members)), checkpoints=True).close()
+
+    # With multi-member gzip, the member starts are saved in the index:
+    monkeypatch.setattr(xcp.cpiofile, "PGZ_BLOCKSIZE", 100000)
+    path = str(tmp_path / "archive.cpio.gz")
+    with open(path, "wb") as archive_file:
+        archive_file.write(create_archive("w|pgz", members))
+    archive = CpioFile.open(path, mode="r:gz", checkpoints=True, index=True)
+    archive.writeindex()
+    points = archive.fileobj.getpoints()
+    assert len(points) == 6  # the starts of 5 gzip members and the end
+    archive.close()
+    archive = CpioFile.open(path, mode="r:gz", checkpoints=True, index=True)
+    assert archive.fileobj.getpoints() == points
+    name = list(members)[-1]
+    assert cast(ExFileObject, archive.extractfile(name)).read() == members[name]
+    archive.close()
+
+
+def test_hardlink_data_member(tmp_path):
+    # type: (pathlib.Path) -> None
+    """Hard links without data are extracted from the member of their inode which has the data"""
+    cpiofile = io.BytesIO()
+    archive = CpioFile.open(fileobj=cpiofile, mode="w:")
+    archive.hardlinks = False  # Write the data with the last link, like GNU cpio
+    for name, ino, devminor, data in [("link1", 7, 1, b""), ("link2", 7, 1, b""),
+                                      ("other", 7, 2, b"other device"),
+                                      ("data", 7, 1, binary_data)]:
+        cpioinfo = CpioInfo(name)
+        cpioinfo.mode = 0o100644
+        cpioinfo.nlink = 3 if devminor == 1 else 1
+        cpioinfo.ino, cpioinfo.devminor, cpioinfo.size = ino, devminor, len(data)
+        archive.addfile(cpioinfo, io.BytesIO(data))
+    archive.close()
+
+    archive = CpioFile.open(fileobj=io.BytesIO(cpiofile.getvalue()), mode="r:")
+    assert cast(ExFileObject, archive.extractfile("link1")).read() == binary_data
+    assert cast(ExFileObject, archive.extractfile("other")).read() == b"other device"
+    archive.close()
+
+    archive = CpioFile.open(fileobj=io.BytesIO(cpiofile.getvalue()), mode="r:")
+    archive.extractall(str(tmp_path))
+    archive.close()
+    assert (tmp_path / "link2").read_bytes() == binary_data
+    assert os.path.samefile(str(tmp_path / "link1"), str(tmp_path / "link2"))
+
+
+def test_append(tmp_path, monkeypatch):
+    # type: (pathlib.Path, pytest.MonkeyPatch) -> None
+    """Appending finds the trailer from the end and falls back to reading all headers"""
+    name = str(tmp_path / "archive.cpio")
+    with open(name, "wb") as archive_file:
+        archive_file.write(create_archive("w:", {"first": b"1"}) + 400 * b"\0")
+
+    def append(member):
+        # type: (str) -> None
+        create_archive("a", {member: member.encode()}, name)
+
+    with monkeypatch.context() as patch:
+        patch.setattr(CpioFile, "__next__", lambda self: pytest.fail("headers read"))
+        append("second")
+        append("third")
+    with open(name, "ab") as archive_file:
+        archive_file.write(b"garbage")
+    append("fourth")
+
+    archive = CpioFile.open(name, "r:")
+    assert archive.getnames() == ["first", "second", "third", "fourth"]
+    assert cast(ExFileObject, archive.extractfile("third")).read() == b"third"
+    archive.close()
+    with open(name, "rb") as result:
+        assert result.read().count(xcp.cpiofile.TRAILER_NAME) == 1
+
+    # The members of the archive are read when they are needed while appending:
+    name = str(tmp_path / "appended.cpio")
+    create_archive("w:", {"first": b"1", "second": b"2"}, name)
+    archive = CpioFile.open(name, "a")
+    cpioinfo = CpioInfo("third")
+    cpioinfo.size = 5
+    archive.addfile(cpioinfo, io.BytesIO(b"third"))
+    assert archive.getmembers()[0].name == "first"
+    assert archive.getnames() == ["first", "second", "third"]
+    assert archive.getmember("second").offset_data < archive.getmember("third").offset
+    archive.close()
+    archive = CpioFile.open(name, "r:")
+    assert archive.getnames() == ["first", "second", "third"]
+    assert cast(ExFileObject, archive.extractfile("third")).read() == b"third"
+    archive.close()
+
+    # Iterating before and after adding members keeps the existing members:
+    iterated = str(tmp_path / "iterated.cpio")
+    create_archive("w:", {"first": b"1", "second": b"2"}, iterated)
+    for added in ("third", "fourth"):
+        archive = CpioFile.open(iterated, "a")
+        names = [member.name for member in archive]
+        assert [member.name for member in list(archive)] == names
+        cpioinfo = CpioInfo(added)
+        cpioinfo.size = len(added)
+        archive.addfile(cpioinfo, io.BytesIO(added.encode()))
+        assert [member.name for member in archive] == names + [added]
+        archive.close()
+    archive = CpioFile.open(iterated, "r:")
+    assert archive.getnames() == ["first", "second", "third", "fourth"]
+    assert cast(ExFileObject, archive.extractfile("fourth")).read() == b"fourth"
+    archive.close()
+
+    create_archive("a", {"fourth": b"fourth"}, name, index=True)
+    archive = CpioFile.open(name, "r:", index=True)
+    assert archive._loaded  # pylint: disable=protected-access
+    assert archive.getnames() == ["first", "second", "third", "fourth"]
+    archive.close()
+
+
+def test_deduplicate(tmp_path):
+    # type: (pathlib.Path) -> None
+    """With deduplicate, add() stores files with the same content as hard links"""
+    firmware = os.urandom(100000)
+    source = tmp_path / "source"
+    for subdir in ("abi1", "abi2", "abi3"):
+        (source / subdir).mkdir(parents=True)
+        (source / subdir / "firmware.bin").write_bytes(firmware)
+        (source / subdir / "module.ko").write_bytes(subdir.encode())
+        (source / subdir / "empty").write_bytes(b"")
+    # Files with the same content but other permissions are not merged:
+    (source / "abi1" / "script").write_bytes(b"#!/bin/sh\n")
+    (source / "abi2" / "script").write_bytes(b"#!/bin/sh\n")
+    os.chmod(str(source / "abi1" / "script"), 0o755)
+    os.chmod(str(source / "abi2" / "script"), 0o600)
+    for path in source.glob("*/*"):
+        os.utime(str(path), (1000000, 1000000))
+
+    sizes = []
+    for deduplicate in (False, True):
+        name = str(tmp_path / ("archive%d.cpio" % deduplicate))
+        archive = CpioFile.open(name, "w:")
+        archive.deduplicate = deduplicate
+        archive.add(str(source), "source")
+        archive.close()
+        sizes.append(os.path.getsize(name))
+    assert sizes[0] - sizes[1] == 2 * len(firmware)
+
+    archive = CpioFile.open(name, "r:")
+    copies = [m for m in archive.getmembers() if m.name.endswith("firmware.bin")]
+    assert [m.nlink for m in copies] == [3, 3, 3]
+    assert len(set(m.ino for m in copies)) == 1
+    assert sum(m.nlink for m in archive.getmembers() if m.name.endswith("module.ko")) == 3
+    archive.extractall(str(tmp_path / "out"))
+    archive.close()
+    out = tmp_path / "out" / "source"
+    for subdir in ("abi1", "abi2", "abi3"):
+        assert (out / subdir / "firmware.bin").read_bytes() == firmware
+        assert (out / subdir / "module.ko").read_bytes() == subdir.encode()
+    assert os.path.samefile(str(out / "abi1" / "firmware.bin"), str(out / "abi3" / "firmware.bin"))
+    assert not os.path.samefile(str(out / "abi1" / "script"), str(out / "abi2" / "script"))
+    assert os.stat(str(out / "abi1" / "script")).st_mode == 0o100755
+    assert os.stat(str(out / "abi2" / "script")).st_mode == 0o100600
+
+
+def test_add_prefetch(tmp_path, monkeypatch):
+    # type: (pathlib.Path, pytest.MonkeyPatch) -> None
+    """add() with workers reads files ahead and writes the same sorted archive"""
+    monkeypatch.setattr(xcp.cpiofile, "PREFETCH_SIZE", 1000)
+    source = tmp_path / "source"
+    for subdir in ("b", "a/c"):
+        (source / subdir).mkdir(parents=True)
+    for i in (3, 1, 2, 10):
+        (source / "b" / ("file%d" % i)).write_bytes(os.urandom(i * 500))
+    (source / "a" / "c" / "data").write_bytes(binary_data)
+    os.symlink("../b/file1", str(source / "a" / "link"))
+
+    archives = []
+    for workers in (None, 3):
+        cpiofile = io.BytesIO()
+        archive = CpioFile.open(fileobj=cpiofile, mode="w:")
+        archive.add(str(source), "source", workers=workers)
+        archive.close()
+        archives.append(cpiofile.getvalue())
+    assert archives[0] == archives[1]
+
+    archive = CpioFile.open(fileobj=io.BytesIO(archives[1]), mode="r:")
+    assert archive.getnames() == [
+        "source", "source/a", "source/a/c", "source/a/c/data", "source/a/link", "source/b",
+        "source/b/file1", "source/b/file10", "source/b/file2", "source/b/file3"]
+    member = "source/b/file10"
+    assert cast(ExFileObject, archive.extractfile(member)).read() == (
+        source / "b" / "file10").read_bytes()
+    archive.close()
+
+
+def test_scan_buffer(tmp_path):
+    # type: (pathlib.Path) -> None
+    """Members scanned from the buffer of a BytesIO or mmap are the same as those from next()"""
+    cpiofile = io.BytesIO()
+    archive = CpioFile.open(fileobj=cpiofile, mode="w:")
+    for name, mode, data in [("dir", 0o40755, b""), ("dir/file", 0o100644, binary_data),
+                             ("dir/link", 0o120777, b"file"), ("empty", 0o100600, b"")]:
+        cpioinfo = CpioInfo(name)
+        cpioinfo.mode, cpioinfo.mtime = mode, 1234567890
+        if mode == 0o120777:
+            cpioinfo.linkname = data.decode()  # Written by tobuf()
+            data = b""
+        cpioinfo.size = len(data)
+        archive.addfile(cpioinfo, io.BytesIO(data))
+    archive.close()
+    data = cpiofile.getvalue()
+    path = tmp_path / "archive.cpio"
+
+    def members(**kwargs):
+        # type: (Any) -> list[tuple[object, ...]]
+        archive = CpioFile.open(mode="r:", **kwargs)
+        result = [tuple(getattr(member, slot) for slot in CpioInfo.__slots__[:-2])
+                  for member in archive.getmembers()]
+        archive.close()
+        return result
+
+    # With the trailer, without the trailer and with an invalid header after the members:
+    for tail in (data[-124:], b"", b"070701" + b"Z" * 200):
+        path.write_bytes(data[:-124] + tail)
+        expected = members(fileobj=io.BufferedReader(io.BytesIO(data[:-124] + tail)))
+        assert len(expected) == 4
+        assert members(fileobj=io.BytesIO(data[:-124] + tail)) == expected
+        assert members(name=str(path), usemmap=True) == expected
+    names = CpioInfo.__slots__[:-2]
+    link = dict(zip(names, expected[2]))
+    assert (link["name"], link["linkname"], link["size"]) == ("dir/link", "file", 0)
+
+
+def test_opensegments(tmp_path):
+    # type: (pathlib.Path) -> None
+    """opensegments() reads all segments of an initrd of concatenated archives"""
+    segments = [
+        ("w:", {"kernel/x86/microcode/GenuineIntel.bin": binary_data}),
+        ("w:gz", {"init": b"#!/bin/sh\n", "bin/busybox": os.urandom(5000)}),
+        ("w:", {"etc/extra.conf": b"extra\n"}),
+        ("w:xz", {"lib/modules/module.ko": b"module" * 1000}),
+    ]
+    initrd = b""
+    offsets = []
+    for mode, members in segments:
+        offsets.append(len(initrd))
+        initrd += create_archive(mode, members)
+        initrd += b"\0" * (-len(initrd) % 512)  # pad like cpio -H newc
+    path = tmp_path / "initrd.img"
+    path.write_bytes(initrd)
+
+    for kwargs in ({"name": str(path)}, {"fileobj": io.BytesIO(initrd)}):
+        found = []
+        for archive in CpioFile.opensegments(**kwargs):  # type: ignore[arg-type]
+            assert archive.segmentoffset == offsets[archive.segment]
+            assert archive.comptype == (segments[archive.segment][0][2:] or "cpio")
+            data = dict((cpioinfo.name, cast(ExFileObject, archive.extractfile(cpioinfo)).read())
+                        for cpioinfo in archive)
+            found.append(data)
+        assert found == [members for _, members in segments]
+
+    with pytest.raises(xcp.cpiofile.ReadError):
+        list(CpioFile.opensegments(fileobj=io.BytesIO(initrd[:offsets[1]] + b"junk")))
+
+
+@pytest.mark.parametrize("mode", ["w:", "w|", "w|gz"])
+def test_crc_format(tmp_path, mode):
+    # type: (pathlib.Path, str) -> None
+    """The CRC format (070702) is written with the sum of the data and verified on reading"""
+    data = os.urandom(100000)
+    source = tmp_path / "source"
+    source.write_bytes(data)
+    path = tmp_path / "archive.cpio"
+    archive = CpioFile.open(str(path), mode)
+    archive.format = xcp.cpiofile.MAGIC_CRC
+    archive.add(str(source), "file")
+    archive.addfile(CpioInfo("empty"), io.BytesIO())
+    archive.close()
+
+    archive = CpioFile.open(str(path), "r")
+    cpioinfo = archive.getmember("file")
+    assert cpioinfo.magic == xcp.cpiofile.MAGIC_CRC
+    assert cpioinfo.check == sum(bytearray(data)) & 0xFFFFFFFF
+    assert cast(ExFileObject, archive.extractfile("file")).read() == data
+    assert archive.verify() == []
+    archive.close()
+
+    if mode != "w:":
+        return
+    raw = bytearray(path.read_bytes())
+    assert raw.startswith(b"070702") and raw.count(b"070702") == 3
+    raw[cpioinfo.offset_data + 1000] ^= 1  # corrupt the data
+    path.write_bytes(raw)
+    archive = CpioFile.open(str(path), "r")
+    assert [m.name for m in archive.verify()] == ["file"]
+    assert [m.name for m in archive.verify(workers=2)] == ["file"]
+    with pytest.raises(xcp.cpiofile.ReadError, match="checksum"):
+        cast(ExFileObject, archive.extractfile("file")).read()
+    archive.errorlevel = 2
+    for workers in (None, 2):
+        with pytest.raises(xcp.cpiofile.ReadError, match="checksum"):
+            archive.extractall(str(tmp_path / "extracted"), workers=workers)
+    archive.close()
+
+
+class SlowReader(io.RawIOBase):
+    """A file object returning the data in small pieces, like a network download"""
+
+    def __init__(self, data, fail=False):
+        # type: (bytes, bool) -> None
+        super(SlowReader, self).__init__()
+        self.data = io.BytesIO(data)
+        self.fail = fail
+
+    def readable(self):
+        # type: () -> bool
+        return True
+
+    def read(self, size=-1):
+        # type: (int | None) -> bytes
+        data = self.data.read(min(size or 1000, 1000))
+        if self.fail and not data:
+            raise IOError("connection reset")
+        return data
+
+
+@pytest.mark.parametrize("mode", ["w|", "w|gz", "w|xz"])
+def test_extractstream(tmp_path, mode):
+    # type: (pathlib.Path, str) -> None
+    """extractstream() and extractasync() extract an archive while it is downloaded"""
+    members = {"first": b"1", "dir/second": binary_data, "third": os.urandom(100000)}
+    data = create_archive(mode, members)
+
+    CpioFile.extractstream(SlowReader(data), str(tmp_path / "sync"), bufsize=4096, blocks=2)
+    for name, content in members.items():
+        assert (tmp_path / "sync" / name).read_bytes() == content
+
+    asyncio = pytest.importorskip("asyncio")
+    loop = asyncio.new_event_loop()
+    futures = []  # type: list[Any]
+
+    def start():
+        # type: () -> None
+        # Called by the running event loop, which extractasync() uses by default:
+        futures.append(CpioFile.extractasync(SlowReader(data), str(tmp_path / "async"),
+                                             include="dir/*"))
+    try:
+        loop.call_soon(start)
+        loop.run_until_complete(asyncio.sleep(0))
+        loop.run_until_complete(futures[0])
+    finally:
+        loop.close()
+    assert os.listdir(str(tmp_path / "async")) == ["dir"]
+    assert (tmp_path / "async/dir/second").read_bytes() == binary_data
+
+    # A truncated download raises the error of the reader:
+    with pytest.raises(IOError, match="connection reset"):
+        CpioFile.extractstream(SlowReader(data[:len(data) // 2], fail=True),
+                               str(tmp_path / "failed"))
+
+    # Invalid data stops the download instead of blocking it:
+    with pytest.raises(xcp.cpiofile.ReadError):
+        CpioFile.extractstream(SlowReader(b"junk" * 100000), str(tmp_path / "failed"),
+                               blocks=2)
+
+
+@pytest.mark.parametrize("workers", [None, 2])
+def test_extract_attributes(tmp_path, monkeypatch, workers):
+    # type: (pathlib.Path, pytest.MonkeyPatch, int | None) -> None
+    """Extraction looks up each uid and gid once and sets the attributes of files via their fd"""
+    data = io.BytesIO()
+    archive = CpioFile.open(fileobj=data, mode="w:")
+    for i in range(10):
+        cpioinfo = CpioInfo("file%d" % i)
+        cpioinfo.size, cpioinfo.mode, cpioinfo.mtime = 1, 0o100640, 1000000 + i
+        cpioinfo.uid, cpioinfo.gid = 1000 + i % 2, 100
+        archive.addfile(cpioinfo, io.BytesIO(b"%d" % i))
+    archive.close()
+    path = tmp_path / "archive.cpio"
+    path.write_bytes(data.getvalue())
+
+    lookups = []
+    class NameService(object):  # pylint: disable=too-few-public-methods
+        @staticmethod
+        def getpwuid(uid):
+            # type: (int) -> tuple[str, str, int]
+            lookups.append(("uid", uid))
+            return ("user", "x", uid)
+
+        @staticmethod
+        def getgrgid(gid):
+            # type: (int) -> tuple[str, str, int]
+            lookups.append(("gid", gid))
+            return ("group", "x", gid)
+
+    owners = []
+    monkeypatch.setattr(xcp.cpiofile, "PWD", NameService)
+    monkeypatch.setattr(xcp.cpiofile, "GRP", NameService)
+    monkeypatch.setattr(os, "geteuid", lambda: 0)
+    monkeypatch.setattr(os, "fchown", lambda fd, uid, gid: owners.append((fd, uid, gid)))
+    monkeypatch.setattr(os, "chown", lambda path, uid, gid: owners.append((path, uid, gid)))
+
+    archive = CpioFile.open(str(path), "r:")
+    archive.extractall(str(tmp_path / "out"), workers=workers)
+    archive.close()
+    assert sorted(lookups) == [("gid", 100), ("uid", 1000), ("uid", 1001)]
+    # Only created parent directories are changed by path:
+    assert all(os.path.isdir(owner[0]) for owner in owners if not isinstance(owner[0], int))
+    assert sorted(owner[1:] for owner in owners if isinstance(owner[0], int)) == \
+        [(1000, 100)] * 5 + [(1001, 100)] * 5
+    for i in range(10):
+        st = os.stat(str(tmp_path / "out" / ("file%d" % i)))
+        assert (st.st_mode, st.st_mtime) == (0o100640, 1000000 + i)
+
+
+def test_copyfileobj(tmp_path, monkeypatch):
+    # type: (pathlib.Path, pytest.MonkeyPatch) -> None
+    """copyfileobj() returns the bytes copied and lets the kernel copy between files"""
+    data = os.urandom(3 * 1024 * 1024 + 5)
+    source = tmp_path / "source"
+    source.write_bytes(data)
+    calls = record_calls(monkeypatch, xcp.cpiofile, "_copyfd")
+
+    with open(str(source), "rb") as src, open(str(tmp_path / "target"), "wb") as dst:
+        dst.write(b"head")
+        src.seek(5)
+        assert xcp.cpiofile.copyfileobj(src, dst, 1000) == 1000
+        assert src.tell() == 1005 and dst.tell() == 1004
+        assert xcp.cpiofile.copyfileobj(src, dst) == len(data) - 1005
+        dst.write(b"tail")
+    assert (tmp_path / "target").read_bytes() == b"head" + data[5:] + b"tail"
+    assert [args[3] for args in calls] == [len(data) - 1005]  # 1000 bytes in user space
+
+    # In-memory files are copied using readinto() into one buffer:
+    target = io.BytesIO()
+    assert xcp.cpiofile.copyfileobj(io.BytesIO(data), target) == len(data)
+    assert target.getvalue() == data
+    assert xcp.cpiofile.copyfileobj(io.BytesIO(data), target, 0) == 0
+    with pytest.raises(IOError, match="end of file"):
+        xcp.cpiofile.copyfileobj(io.BytesIO(data), io.BytesIO(), len(data) + 1)
+    assert len(calls) == 1
@@ -50,16 +50,30 @@ import sys
 import os
 import shutil
 import stat
+import binascii
 import errno
+import fnmatch
+import functools
+import hashlib
+import subprocess
+import threading
 import time
 import struct
 import copy
 import io
-from typing import IO, TYPE_CHECKING, Any, List, Optional, cast
+import json
+import mmap
+from array import array
+from bisect import bisect_left, bisect_right
+import zlib
+from collections import deque
+from typing import IO, TYPE_CHECKING, Any, Iterator, List, Optional, Tuple, Type, cast
 
 import six
+from six.moves import queue
 
 if TYPE_CHECKING:
+    from concurrent.futures import ThreadPoolExecutor as Executor
     from gzip import GzipFile
     from typing_extensions import Literal
 
@@ -75,6 +89,16 @@ try:
 except ImportError:
     GRP = PWD = None  # type: ignore[assignment] # pragma: no cover
 
+try:
+    import concurrent.futures
+    ThreadPoolExecutor = concurrent.futures.ThreadPoolExecutor  # type: Optional[Type[Executor]]
+except ImportError:
+    ThreadPoolExecutor = None  # pragma: no cover
+
+# If os.utime() accepts a file descriptor, extraction sets the owner, mode and
+# mtime of regular files using the descriptor of the file written:
+_UTIME_FD = os.utime in getattr(os, "supports_fd", ())
+
 # pylint: skip-file
 # from cpiofile import *
 __all__ = ["CpioFile", "CpioInfo", "is_cpiofile", "CpioError"]
@@ -83,11 +107,26 @@ __all__ = ["CpioFile", "CpioInfo", "is_cpiofile", "CpioError"]
 # cpio constants
 #---------------------------------------------------------
 MAGIC_NEWC      = 0x070701           # magic for SVR4 portable format (no CRC)
+MAGIC_CRC       = 0x070702           # magic for SVR4 portable format with CRC
 TRAILER_NAME    = b"TRAILER!!!"      # filename in final member
 WORDSIZE        = 4                  # pad size
 NUL             = b"\0"              # the null character
 BLOCKSIZE       = 512                # length of processing blocks
 HEADERSIZE_SVR4 = 110                # length of fixed header
+NEWC_MAGIC      = b"%06X" % MAGIC_NEWC  # magic at the start of each header
+CRC_MAGIC       = b"%06X" % MAGIC_CRC   # the same for the CRC format
+MAGICS          = {NEWC_MAGIC: MAGIC_NEWC, CRC_MAGIC: MAGIC_CRC}
+CHECK_OFFSET    = 102                # offset of the check field in a header
+NEWC_FIELDS     = struct.Struct(">13L")  # the header fields after unhexlify()
+PGZ_BLOCKSIZE   = 1024 * 1024        # uncompressed size of "pgz" gzip members
+GZ_CHECKPOINTS  = 4 * 1024 * 1024    # default spacing of "r:gz" checkpoints
+GZ_MAGIC        = b"\037\213"        # magic of gzip members
+PREFETCH_SIZE   = 1024 * 1024        # files read ahead by add() with workers
+COPY_BUFSIZE    = 1024 * 1024        # maximum block size of copyfileobj()
+PIPE_BLOCKS     = 16                 # blocks queued between extractstream() threads
+TRAILER_SEARCH  = 64 * 1024          # bytes searched back for the trailer by "a"
+INDEX_SUFFIX    = ".idx"             # suffix of member index files
+INDEX_VERSION   = 2                  # format version of member index files
 
 #---------------------------------------------------------
 # Bits used in the mode field, values in octal.
@@ -120,27 +159,109 @@ TOEXEC  = 0o001           # execute/search by other
 def copyfileobj(src, dst, length=None):
     """Copy length bytes from fileobj src to fileobj dst.
        If length is None, copy the entire content.
+       Return the number of bytes copied.
+       Between plain files, the data is copied by the kernel. Else, it is
+       read into one reused buffer if src has readinto(), so dst.write()
+       must not keep a reference to the data passed to it.
     """
     if length == 0:
-        return
+        return 0
+    copied = _copyfilefd(src, dst, length)
+
+    # Read blocks of the remaining length, up to COPY_BUFSIZE, or of growing
+    # size if the length is unknown, so that small files need small buffers.
+    readinto = getattr(src, "readinto", None)
+    bufsize = min(length, COPY_BUFSIZE) if length is not None else BLOCKSIZE * 32
+    buf = view = None
+    while length is None or copied < length:
+        size = bufsize if length is None else min(bufsize, length - copied)
+        if readinto is not None:
+            if buf is None or len(buf) < size:
+                buf = bytearray(size)
+                view = memoryview(buf)
+            data = view[:readinto(view[:size]) or 0]
+        else:
+            data = src.read(size)
+        if not len(data):
+            break
+        dst.write(data)
+        copied += len(data)
+        if length is None and len(data) == bufsize and bufsize < COPY_BUFSIZE:
+            bufsize *= 2
+    if length is not None and copied < length:
+        raise IOError("end of file reached")
+    return copied
+
+def _copyfilefd(src, dst, length):
+    """Copy length bytes (or all remaining, if length is None) from the
+       current position of the plain file src to dst using _copyfd() and
+       return the number of bytes copied, 0 if the files are not plain files
+       or the length is small.
+    """
+    if length is not None and length < 64 * 1024:
+        return 0  # Not worth the additional system calls
+    infd, outfd = _filefd(src), _filefd(dst)
+    if infd is None or outfd is None:
+        return 0
+    pos = src.tell()
     if length is None:
-        shutil.copyfileobj(src, dst)
-        return
-
-    bufsize = 16 * 1024
-    blocks, remainder = divmod(length, bufsize)
-    for b in range(blocks):
-        buf = src.read(bufsize)
-        if len(buf) < bufsize:
-            raise IOError("end of file reached")
-        dst.write(buf)
-
-    if remainder != 0:
-        buf = src.read(remainder)
-        if len(buf) < remainder:
+        length = max(os.fstat(infd).st_size - pos, 0)
+    dst.flush()
+    copied = _copyfd(infd, outfd, pos, length)
+    if copied:
+        # The kernel moved the position of outfd, but not the one of infd
+        src.seek(pos + copied)
+        dst.seek(os.lseek(outfd, 0, os.SEEK_CUR))
+    return copied
+
+def _checksum(data, check=0):
+    """Return check plus the sum of all bytes of data, modulo 2**32, which
+       is the "CRC" of the data of a member of a cpio archive in the
+       newc format with CRC (070702).
+    """
+    # The first sum of Adler-32 is 1 plus the sum of the bytes modulo
+    # 65521, which is the exact sum for blocks of up to 256 bytes and is
+    # computed much faster than by iterating over the bytes with sum().
+    view = memoryview(data)
+    adler32 = zlib.adler32
+    for i in range(0, len(view), 256):
+        check += (adler32(view[i:i + 256]) & 0xFFFF) - 1
+    return check & 0xFFFFFFFF
+
+def _prechecksum(fileobj, length):
+    """Return the _checksum() of the next length bytes of fileobj and a file
+       object to read them from again: fileobj itself if it is seekable, else
+       an in-memory copy of the data.
+    """
+    if isinstance(fileobj, io.BytesIO) and hasattr(fileobj, "getbuffer"):
+        pos = fileobj.tell()
+        return _checksum(fileobj.getbuffer()[pos:pos + length]), fileobj
+    try:
+        pos = fileobj.tell()
+        fileobj.seek(pos)
+    except (AttributeError, EnvironmentError, ValueError):
+        copy = io.BytesIO()
+        check = _copychecksum(fileobj, copy, length)
+        copy.seek(0)
+        return check, copy
+    check = _copychecksum(fileobj, None, length)
+    fileobj.seek(pos)
+    return check, fileobj
+
+def _copychecksum(src, dst, length):
+    """Copy length bytes from fileobj src to fileobj dst like copyfileobj()
+       (or only read them if dst is None) and return their _checksum().
+    """
+    check = 0
+    while length > 0:
+        buf = src.read(min(length, 1024 * 1024))
+        if not buf:
             raise IOError("end of file reached")
-        dst.write(buf)
-    return
+        if dst is not None:
+            dst.write(buf)
+        check = _checksum(buf, check)
+        length -= len(buf)
+    return check
 
 FILEMODE_TABLE = (
     ((S_IFLNK,      "l"),
@@ -169,6 +290,151 @@ FILEMODE_TABLE = (
      (TOEXEC,       "x"))
 )
 
+def _filefd(fileobj):
+    """Return the file descriptor of fileobj if it is a plain, regular file
+       (and not e.g. a compressed or an in-memory file object), else None.
+    """
+    if not isinstance(fileobj, (io.FileIO, io.BufferedReader,
+                                io.BufferedWriter, io.BufferedRandom)):
+        return None
+    try:
+        fd = fileobj.fileno()
+        if stat.S_ISREG(os.fstat(fd).st_mode):
+            return fd
+    except (EnvironmentError, ValueError):
+        pass
+    return None
+
+def _copyfd(infd, outfd, offset, length):
+    """Copy length bytes starting at offset of the file descriptor infd to
+       the current position of outfd within the kernel, using
+       os.copy_file_range() or os.sendfile(), whichever works first.
+       The file position of infd is not changed.  Return the number of
+       bytes copied, which is less than length if the kernel could not copy
+       the remaining data, which then has to be copied by other means.
+    """
+    copied = 0
+    for method in ("copy_file_range", "sendfile"):
+        func = getattr(os, method, None)
+        if func is None:
+            continue
+        try:
+            while copied < length:
+                if method == "copy_file_range":
+                    n = func(infd, outfd, length - copied, offset + copied)
+                else:
+                    n = func(outfd, infd, offset + copied, length - copied)
+                if n == 0:  # unexpected end of file
+                    return copied
+                copied += n
+            return copied
+        except EnvironmentError:
+            # Not supported for this pair of files, try the next method.
+            continue
+    return copied
+
+def _gzipmember(data, compresslevel, mtime):
+    """Return data compressed as a complete gzip member for the "pgz"
+       compression.  The header has an extra field "CP" holding the size
+       of the whole member, so that readers can find the start of the
+       next member without decompressing this one.
+    """
+    cmp = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = cmp.compress(data) + cmp.flush()
+    header = struct.pack("<BBBBLBBHBBHL", 0o37, 0o213, 8, 4, mtime, 0, 255,
+                         8, ord("C"), ord("P"), 4, 28 + len(deflated))
+    trailer = struct.pack("<LL", zlib.crc32(data) & 0xffffffff,
+                          len(data) & 0xffffffff)
+    return b"".join((header, deflated, trailer))
+
+def _gunzipmember(data):
+    """Return the decompressed data of a gzip member of the "pgz"
+       compression, which is passed without its header.
+    """
+    try:
+        decompressed = zlib.decompress(data[:-8], -zlib.MAX_WBITS)
+    except zlib.error as e:
+        raise CompressionError("invalid compressed data: %s" % e)
+    crc, isize = struct.unpack("<LL", data[-8:])
+    if crc != zlib.crc32(decompressed) & 0xffffffff or \
+       isize != len(decompressed) & 0xffffffff:
+        raise CompressionError("CRC check of gzip member failed")
+    return decompressed
+
+def _getcomptype(buf):
+    """Return the compression type of data starting with buf, "cpio" if
+       none is detected from its magic bytes.
+    """
+    if buf.startswith(b"\037\213\010"):
+        return "gz"
+    if buf.startswith(b"BZh91"):
+        return "bz2"
+    if buf.startswith(b"\xfd7zXZ\0"):
+        return "xz"
+    for comptype, _, _, magic in FILTERS:
+        if buf.startswith(magic):
+            return comptype
+    return "cpio"
+
+def _cpu_count():
+    """Return the number of CPUs, used as default number of threads."""
+    try:
+        return os.cpu_count() or 1
+    except AttributeError:  # pragma: no cover
+        import multiprocessing
+        return multiprocessing.cpu_count()
+
+def _filedigest(name):
+    """Return the SHA-256 digest of the content of the file name."""
+    digest = hashlib.sha256()
+    with bltn_open(name, "rb") as f:
+        while True:
+            buf = f.read(1024 * 1024)
+            if not buf:
+                return digest.digest()
+            digest.update(buf)
+
+def _prefetch(name, size):
+    """Open the file name to be added by CpioFile.add(). If its size is at
+       most PREFETCH_SIZE, read it and return it as an in-memory file.
+    """
+    f = bltn_open(name, "rb")
+    if size > PREFETCH_SIZE:
+        return f
+    try:
+        return io.BytesIO(f.read())
+    finally:
+        f.close()
+
+def _membername(name):
+    """Return name without a leading "/" or "./" for matching by _selector()."""
+    name = six.ensure_str(name)
+    while True:
+        if name.startswith("/"):
+            name = name[1:]
+        elif name.startswith("./"):
+            name = name[2:]
+        else:
+            return name
+
+def _selector(include=None, exclude=None):
+    """Return a function which tells whether a CpioInfo object is selected
+       by the include and exclude filters of CpioFile.select().
+    """
+    def matcher(filt):
+        if filt is None or callable(filt):
+            return filt
+        patterns = [_membername(p) for p in ([filt] if isinstance(filt, (str, bytes, six.text_type))
+                                             else filt)]
+        return lambda cpioinfo: any(fnmatch.fnmatchcase(_membername(cpioinfo.name), p)
+                                    for p in patterns)
+
+    included, excluded = matcher(include), matcher(exclude)
+    def selected(cpioinfo):
+        return ((included is None or bool(included(cpioinfo)))
+                and (excluded is None or not excluded(cpioinfo)))
+    return selected
+
 def filemode(mode):
     """Convert a file's mode to a string of the form
        -rwxrwxrwx.
@@ -208,6 +474,60 @@ class StreamError(CpioError):
     """Exception for unsupported operations on stream-like CpioFiles."""
     pass
 
+#---------------------------------------------------------
+# External compression filter programs
+#---------------------------------------------------------
+# Compressions which Python's own modules provide:
+BUILTIN_COMPTYPES = ("cpio", "gz", "pgz", "bz2", "xz")
+
+# Registry of external filter programs, consulted in order. Each entry is
+# (comptype, compress command, decompress command, magic of the compressed
+# data). The first one found in $PATH is used for a compression type.
+FILTERS = [
+    ("gz",  ["pigz", "-c"],           ["pigz", "-d", "-c"],       b"\037\213\010"),
+    ("bz2", ["lbzip2", "-c"],         ["lbzip2", "-d", "-c"],     b"BZh"),
+    ("bz2", ["pbzip2", "-c"],         ["pbzip2", "-d", "-c"],     b"BZh"),
+    ("xz",  ["xz", "-T0", "-c"],      ["xz", "-T0", "-d", "-c"],  b"\xfd7zXZ\0"),
+    ("zst", ["zstd", "-T0", "-q", "-c"], ["zstd", "-d", "-q", "-c"], b"\x28\xb5\x2f\xfd"),
+    ("lz4", ["lz4", "-q", "-c"],      ["lz4", "-d", "-q", "-c"],  b"\x04\x22\x4d\x18"),
+]
+
+_which_cache = {}  # type:dict[str, str | None]
+
+def register_filter(comptype, compress, decompress, magic):
+    # type:(str, list[str], list[str], bytes) -> None
+    """Register an external filter program for the compression `comptype`,
+       which is preferred over the registered ones. `compress` and
+       `decompress` are the commands which filter from stdin to stdout,
+       `magic` are the first bytes of data compressed by it.
+    """
+    FILTERS.insert(0, (comptype, compress, decompress, magic))
+
+def _which(program):
+    """Return the path of program in $PATH or None (cached)."""
+    if program not in _which_cache:
+        try:
+            which = shutil.which
+        except AttributeError:  # pragma: no cover
+            from distutils.spawn import find_executable as which
+        _which_cache[program] = which(program)
+    return _which_cache[program]
+
+def _getfilter(comptype, mode):
+    """Return the command of the first filter for comptype which is present
+       at runtime for compressing (mode "w") or decompressing (mode "r"),
+       or None if there is none.
+    """
+    for filtertype, compress, decompress, _ in FILTERS:
+        command = decompress if mode == "r" else compress
+        if filtertype == comptype and _which(command[0]):
+            return command
+    return None
+
+def available_filters():
+    """Return the compression types for which a filter program is present."""
+    return sorted(set(f[0] for f in FILTERS if _getfilter(f[0], "r")))
+
 #---------------------------
 # internal stream interface
 #---------------------------
@@ -236,6 +556,93 @@ class _LowLevelFile(object):
     def write(self, s):
         os.write(self.fd, s)
 
+class _FilterProcess(object):
+    """File-like object which compresses or decompresses using an external
+       filter program: In mode "r", read() returns the output of the program
+       for the data of fileobj, in mode "w", data passed to write() is written
+       to fileobj by the program. A thread copies the data between fileobj
+       and the program, unless fileobj is a plain file or a _LowLevelFile,
+       whose descriptor is passed to the program.
+    """
+
+    def __init__(self, command, mode, fileobj):
+        self.command = command
+        self.mode = mode
+        self.fileobj = fileobj
+        self.error = None
+        self.thread = None
+        fd = fileobj.fd if isinstance(fileobj, _LowLevelFile) else _filefd(fileobj)
+        if fd is None:
+            fd = subprocess.PIPE
+        try:
+            if mode == "r":
+                self.proc = subprocess.Popen(command, stdin=fd, stdout=subprocess.PIPE)
+                self.pipe = self.proc.stdout
+                if fd == subprocess.PIPE:
+                    self._start(self._feed)
+            else:
+                self.proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=fd)
+                self.pipe = self.proc.stdin
+                if fd == subprocess.PIPE:
+                    self._start(self._drain)
+        except EnvironmentError as e:
+            raise CompressionError("cannot run %s: %s" % (command[0], e))
+
+    def _start(self, target):
+        self.thread = threading.Thread(target=target)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _feed(self):
+        """Copy the data of fileobj to the program (thread function)."""
+        try:
+            while True:
+                buf = self.fileobj.read(64 * 1024)
+                if not buf:
+                    break
+                self.proc.stdin.write(buf)
+        except EnvironmentError as e:  # e.g. EPIPE, when the program failed
+            self.error = e
+        finally:
+            try:
+                self.proc.stdin.close()
+            except EnvironmentError:
+                pass
+
+    def _drain(self):
+        """Copy the output of the program to fileobj (thread function)."""
+        try:
+            while True:
+                buf = self.proc.stdout.read(64 * 1024)
+                if not buf:
+                    break
+                self.fileobj.write(buf)
+        except EnvironmentError as e:
+            self.error = e
+        finally:
+            self.proc.stdout.close()
+
+    def read(self, size):
+        buf = self.pipe.read(size)
+        if len(buf) < size and self.proc.wait() != 0:
+            raise ReadError("%s failed with exit code %d"
+                            % (self.command[0], self.proc.returncode))
+        return buf
+
+    def write(self, s):
+        self.pipe.write(s)
+
+    def close(self):
+        self.pipe.close()
+        if self.thread is not None:
+            self.thread.join()
+        if self.proc.wait() != 0 and self.mode == "w":
+            raise CompressionError("%s failed with exit code %d"
+                                   % (self.command[0], self.proc.returncode))
+        if self.error is not None and self.mode == "w":
+            raise self.error
+# class _FilterProcess
+
 class _Stream(object):
     """Class that serves as an adapter between CpioFile and
        a stream-like object.  The stream-like object only
@@ -244,10 +651,20 @@ class _Stream(object):
        A stream-like object could be for example: sys.stdin,
        sys.stdout, a socket, a tape device etc.
 
+       The "pgz" compression writes a multi-member gzip stream of
+       PGZ_BLOCKSIZE blocks, which are compressed by `threads` threads.
+       When reading, members with the size in their header (as written
+       by "pgz") are decompressed ahead by `threads` threads, other gzip
+       streams are decompressed serially.
+
+       Compressions which Python does not provide (see FILTERS), and all
+       if `external` is True, use a _FilterProcess of an external program.
+
        _Stream is intended to be used only internally.
     """
 
-    def __init__(self, name, mode, comptype, fileobj, bufsize):
+    def __init__(self, name, mode, comptype, fileobj, bufsize,
+                 threads=None, compresslevel=None, external=False):
         """Construct a _Stream object.
         """
         self._extfileobj = True
@@ -261,33 +678,49 @@ class _Stream(object):
             fileobj = _StreamProxy(fileobj)
             comptype = fileobj.getcomptype()
 
+        self.filter = None
+        if comptype != "cpio" and (external or comptype not in BUILTIN_COMPTYPES):
+            command = _getfilter("gz" if comptype == "pgz" else comptype, mode)
+            if command is None:
+                if comptype not in BUILTIN_COMPTYPES:
+                    raise CompressionError("no program for %r compression found" % comptype)
+            else:
+                self.filter = fileobj
+                fileobj = _FilterProcess(command, mode, fileobj)
+                comptype = "cpio"  # The filter passes uncompressed data
+
         self.name     = name or ""
         self.mode     = mode
         self.comptype = comptype
         self.fileobj  = fileobj
         self.bufsize  = bufsize
-        self.buf      = b""
+        self.buf      = bytearray()
         self.pos      = 0
         self.closed   = False
+        self.gzeof    = False
+        self.executor = None
+        self.pending  = deque()  # type:deque[Any]
 
-        if comptype == "gz":
-            try:
-                import zlib
-            except ImportError:
-                raise CompressionError("zlib module is not available")
+        if comptype in ("gz", "pgz"):
             self.zlib = zlib
             self.crc = zlib.crc32(b"")
             if mode == "r":
+                self.dbuf = bytearray()
                 self._init_read_gz()
+                if comptype == "pgz":
+                    self._init_read_pgz(threads or _cpu_count())
+            elif comptype == "gz":
+                self._init_write_gz(9 if compresslevel is None else compresslevel)
             else:
-                self._init_write_gz()
+                self._init_write_pgz(6 if compresslevel is None else compresslevel,
+                                     threads or _cpu_count())
 
         if comptype == "bz2":
             if mode == "r":
-                self.dbuf = b""
+                self.dbuf = bytearray()
                 self.cmp = bz2.BZ2Decompressor()
             else:
-                self.cmp = bz2.BZ2Compressor()
+                self.cmp = bz2.BZ2Compressor(9 if compresslevel is None else compresslevel)
 
         if comptype == "xz":
             try:
@@ -295,20 +728,22 @@ class _Stream(object):
             except ImportError:
                 raise CompressionError("lzma module is not available")
             if mode == "r":
-                self.dbuf = b""
+                self.dbuf = bytearray()
                 self.cmp = lzma.LZMADecompressor()
-            else:
+            elif compresslevel is None:
                 self.cmp = lzma.LZMACompressor()
+            else:
+                self.cmp = lzma.LZMACompressor(preset=compresslevel)
 
 
     def __del__(self):
         if hasattr(self, "closed") and not self.closed:
             self.close()
 
-    def _init_write_gz(self):
+    def _init_write_gz(self, compresslevel):
         """Initialize for writing with gzip compression.
         """
-        self.cmp = self.zlib.compressobj(9, self.zlib.DEFLATED,
+        self.cmp = self.zlib.compressobj(compresslevel, self.zlib.DEFLATED,
                                             -self.zlib.MAX_WBITS,
                                             self.zlib.DEF_MEM_LEVEL,
                                             0)
@@ -318,24 +753,79 @@ class _Stream(object):
             self.name = self.name[:-3]
         self.__write(six.ensure_binary(self.name) + NUL)
 
+    def _init_write_pgz(self, compresslevel, threads):
+        """Initialize for writing a multi-member gzip stream, which is
+           compressed in blocks by a pool of threads.
+        """
+        self.compresslevel = compresslevel
+        self.mtime = int(time.time())
+        self.threads = threads
+        self.pgzbuf = bytearray()
+        if threads > 1 and ThreadPoolExecutor is not None:
+            self.executor = ThreadPoolExecutor(max_workers=threads)
+
+    def _init_read_pgz(self, threads):
+        """Initialize for decompressing the gzip members ahead in a pool of
+           threads, if the first member has its size in the header.
+        """
+        self.threads = threads
+        if self.gzmembersize is not None and threads > 1 and ThreadPoolExecutor is not None:
+            self.executor = ThreadPoolExecutor(max_workers=threads)
+
     def write(self, s):
         """Write string s to the stream.
         """
         if self.comptype == "gz":
             self.crc = self.zlib.crc32(s, self.crc)
         self.pos += len(s)
+        if self.comptype == "pgz":
+            self.pgzbuf += s
+            while len(self.pgzbuf) >= PGZ_BLOCKSIZE:
+                self._compress_block(bytes(self.pgzbuf[:PGZ_BLOCKSIZE]))
+                del self.pgzbuf[:PGZ_BLOCKSIZE]
+            return
         if self.comptype != "cpio":
             s = cast(bz2.BZ2Compressor, self.cmp).compress(s)
         self.__write(s)
 
+    def _compress_block(self, block):
+        """Compress a block of the "pgz" compression using the thread pool
+           and write the members which are done. At most two blocks per
+           thread are queued, which bounds the memory used.
+        """
+        if self.executor is None:
+            self.__write(_gzipmember(block, self.compresslevel, self.mtime))
+            return
+        self.pending.append(self.executor.submit(_gzipmember, block,
+                                                 self.compresslevel, self.mtime))
+        while len(self.pending) > 2 * self.threads:
+            self.__write(self.pending.popleft().result())
+
+    def _flush_pgz(self):
+        """Compress the last block of the "pgz" compression and write all
+           members which are pending.
+        """
+        if self.pgzbuf or not self.pos:
+            self._compress_block(bytes(self.pgzbuf))
+            self.pgzbuf = bytearray()
+        while self.pending:
+            self.__write(self.pending.popleft().result())
+
     def __write(self, s):
         """Write string s to the stream if a whole new block
            is ready to be written.
         """
         self.buf += s
-        while len(self.buf) > self.bufsize:
-            self.fileobj.write(self.buf[:self.bufsize])
-            self.buf = self.buf[self.bufsize:]
+        if len(self.buf) > self.bufsize:
+            # Write the whole blocks and remove them from the buffer at once.
+            # Deleting from the start of a bytearray does not copy the rest.
+            # The blocks are written from a memoryview, without copying them.
+            end = (len(self.buf) - 1) // self.bufsize * self.bufsize
+            view = memoryview(self.buf)
+            for pos in range(0, end, self.bufsize):
+                self.fileobj.write(view[pos:pos + self.bufsize])
+            del view  # The buffer cannot be resized while it is viewed
+            del self.buf[:end]
 
     def close(self):
         """Close the _Stream object. No operation should be
@@ -344,12 +834,14 @@ class _Stream(object):
         if self.closed:
             return
 
-        if self.mode == "w" and self.comptype != "cpio":
+        if self.mode == "w" and self.comptype == "pgz":
+            self._flush_pgz()
+        elif self.mode == "w" and self.comptype != "cpio":
             self.buf += cast(bz2.BZ2Compressor, self.cmp).flush()
 
         if self.mode == "w" and self.buf:
-            self.fileobj.write(self.buf)
-            self.buf = b""
+            self.fileobj.write(bytes(self.buf))
+            self.buf = bytearray()
             if self.comptype == "gz":
                 # The native zlib crc is an unsigned 32-bit integer, but
                 # the Python wrapper implicitly casts that to a signed C
@@ -360,7 +852,16 @@ class _Stream(object):
                 self.fileobj.write(struct.pack("<L", self.crc & 0xffffffff))
                 self.fileobj.write(struct.pack("<L", self.pos & 0xffffFFFF))
 
-        if not self._extfileobj:
+        if self.executor is not None:
+            for future in self.pending:
+                future.cancel()
+            self.executor.shutdown()
+
+        if self.filter is not None:
+            self.fileobj.close()
+            if not self._extfileobj:
+                self.filter.close()
+        elif not self._extfileobj:
             self.fileobj.close()
 
         self.closed = True
@@ -369,7 +870,8 @@ class _Stream(object):
         """Initialize for reading a gzip compressed fileobj.
         """
         self.cmp = self.zlib.decompressobj(-self.zlib.MAX_WBITS)
-        self.dbuf = b""
+        self.gzheadersize = 10
+        self.gzmembersize = None
 
         # taken from gzip.GzipFile with some alterations
         if self.__read(2) != b"\037\213":
@@ -382,19 +884,30 @@ class _Stream(object):
 
         if flag & 4:
             xlen = ord(self.__read(1)) + 256 * ord(self.__read(1))
-            self.read(xlen)
+            extra = self.__read(xlen)
+            self.gzheadersize += 2 + xlen
+            # Look for the member size written by the "pgz" compression:
+            pos = 0
+            while pos + 4 <= len(extra):
+                length = struct.unpack("<H", extra[pos + 2:pos + 4])[0]
+                if extra[pos:pos + 2] == b"CP" and length == 4:
+                    self.gzmembersize = struct.unpack("<L", extra[pos + 4:pos + 8])[0]
+                pos += 4 + length
         if flag & 8:
             while True:
                 s = self.__read(1)
+                self.gzheadersize += 1
                 if not s or s == NUL:
                     break
         if flag & 16:
             while True:
                 s = self.__read(1)
+                self.gzheadersize += 1
                 if not s or s == NUL:
                     break
         if flag & 2:
             self.__read(2)
+            self.gzheadersize += 2
 
     def tell(self):
         """Return the stream's file pointer position.
@@ -406,10 +919,7 @@ class _Stream(object):
            is forbidden.
         """
         if pos - self.pos >= 0:
-            blocks, remainder = divmod(pos - self.pos, self.bufsize)
-            for i in range(blocks):
-                self.read(self.bufsize)
-            self.read(remainder)
+            self.pos += self._skip(pos - self.pos)
         else:
             raise StreamError("seeking backwards is not allowed")
         return self.pos
@@ -438,34 +948,115 @@ class _Stream(object):
         if self.comptype == "cpio":
             return self.__read(size)
 
-        c = len(self.dbuf)
-        t = [self.dbuf]
-        while c < size:
-            buf = self.__read(self.bufsize)
-            if not buf:
+        while len(self.dbuf) < size and self._fill():
+            pass
+        return self._consume(self.dbuf, size)
+
+    def _skip(self, size):
+        """Discard the next size bytes of the stream and return the number
+           of bytes discarded. Unlike read(), the data is dropped block by
+           block as it is decompressed and never copied out of the buffers.
+        """
+        buf = self.buf if self.comptype == "cpio" else self.dbuf
+        left = size
+        while True:
+            count = min(left, len(buf))
+            del buf[:count]
+            left -= count
+            if not left or not self._fill():
                 break
-            buf = cast(bz2.BZ2Decompressor, self.cmp).decompress(buf)
-            t.append(buf)
-            c += len(buf)
-        t = b"".join(t)
-        self.dbuf = t[size:]
-        return t[:size]
+        return size - left
+
+    def _fill(self):
+        """Append the next block of data to the buffer of the stream:
+           self.buf for uncompressed streams and self.dbuf for compressed
+           ones. Return False at the end of the stream.
+        """
+        if self.comptype == "cpio":
+            buf = self.fileobj.read(self.bufsize)
+            self.buf += buf
+            return bool(buf)
+
+        if self.executor is not None and self.mode == "r":
+            buf = self._read_pgz()
+            if buf is not None:
+                self.dbuf += buf
+                return True
+            # No more members with a size, continue serially (if any)
+            self.executor.shutdown()
+            self.executor = None
+        if self.gzeof:
+            return False
+        if self.comptype in ("gz", "pgz") and self.cmp.unused_data:
+            # The gzip member ended, continue with the next one:
+            if self.gzeof or not self._next_gz_member():
+                return False
+        # Pass the data left in self.buf (after a gzip header or pushed back
+        # after a member) or else the next block of the file without copying.
+        if self.buf:
+            buf, self.buf = self.buf, bytearray()
+        else:
+            buf = self.fileobj.read(self.bufsize)
+        if not buf:
+            return False
+        self.dbuf += cast(bz2.BZ2Decompressor, self.cmp).decompress(buf)
+        return True
+
+    def _read_pgz(self):
+        """Return the decompressed data of the next gzip member which was
+           decompressed ahead, or None if no member with a size follows.
+           Up to two members per thread are read and decompressed ahead.
+        """
+        while self.gzmembersize is not None and len(self.pending) < 2 * self.threads:
+            data = self.__read(self.gzmembersize - self.gzheadersize)
+            self.pending.append(self.executor.submit(_gunzipmember, data))
+            magic = self.__read(2)
+            if magic != b"\037\213":
+                self.gzeof = True
+                self.gzmembersize = None
+                break
+            self.buf[:0] = magic
+            self._init_read_gz()  # A member without size is decompressed serially
+        if not self.pending:
+            return None
+        return self.pending.popleft().result()
+
+    def _next_gz_member(self):
+        """Skip the trailer of the ended gzip member and initialize for
+           reading the next member of a multi-member gzip stream.
+           Return False if no member follows.
+        """
+        self.buf[:0] = self.cmp.unused_data
+        self.__read(8)  # CRC32 and ISIZE
+        magic = self.__read(2)
+        if magic != b"\037\213":
+            self.gzeof = True  # Ignore trailing garbage like gzip does.
+            return False
+        self.buf[:0] = magic
+        self._init_read_gz()
+        return True
 
     def __read(self, size):
         """Return size bytes from stream. If internal buffer is empty,
            read another block from the stream.
         """
-        c = len(self.buf)
-        t = [self.buf]
-        while c < size:
+        while len(self.buf) < size:
             buf = self.fileobj.read(self.bufsize)
             if not buf:
                 break
-            t.append(buf)
-            c += len(buf)
-        t = b"".join(t)
-        self.buf = t[size:]
-        return t[:size]
+            self.buf += buf
+        return self._consume(self.buf, size)
+
+    @staticmethod
+    def _consume(buf, size):
+        """Remove the first size bytes from the bytearray buf and return
+           them. Deleting from the start of a bytearray does not copy the
+           rest, so consuming a buffer in small pieces takes linear time.
+           The bytes are copied once, from a memoryview of buf.
+        """
+        data = memoryview(buf)[:size].tobytes()
+        del buf[:size]
+        return data
 # class _Stream
 
 class _StreamProxy(object):
@@ -483,18 +1074,91 @@ class _StreamProxy(object):
         return self.buf
 
     def getcomptype(self):
-        if self.buf.startswith(b"\037\213\010"):
-            return "gz"
-        if self.buf.startswith(b"BZh91"):
-            return "bz2"
-        if self.buf.startswith(b"\xfd7zXZ\0"):
-            return "xz"
-        return "cpio"
+        return _getcomptype(self.buf)
 
     def close(self):
         self.fileobj.close()
 # class StreamProxy
 
+class _Pipe(io.RawIOBase):
+    """A bounded queue of data blocks which a producer thread passes to a
+       consumer, which reads them as a file object. Used by
+       CpioFile.extractstream() to connect its threads.
+    """
+
+    def __init__(self, blocks):
+        super(_Pipe, self).__init__()
+        self.queue = queue.Queue(blocks)
+        self.cancelled = threading.Event()
+        self.buf = bytearray()
+        self.eof = False
+
+    def readable(self):
+        return True
+
+    def put(self, data):
+        """Pass data, b"" at the end or an exception to the consumer.
+           Return False if the consumer closed the pipe.
+        """
+        while not self.cancelled.is_set():
+            try:
+                self.queue.put(data, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def feed(self, fileobj, bufsize):
+        """Pass the data read from fileobj to the consumer until its end.
+           Runs in the producer thread.
+        """
+        try:
+            while True:
+                data = fileobj.read(bufsize)
+                if not self.put(bytes(data)) or not data:
+                    return
+        except Exception as e:
+            self.put(e)
+
+    def read(self, size=-1):
+        """Return the buffered data or else the next block, up to size bytes.
+           Raise the exception passed by the producer, if any. Return b""
+           once the pipe is closed.
+        """
+        while not self.buf and not self.eof:
+            try:
+                data = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                if self.cancelled.is_set():  # The consumer gave up, end here
+                    return b""
+                continue
+            if isinstance(data, Exception):
+                raise data
+            self.eof = not data
+            self.buf += data
+        if size is None or size < 0:
+            size = len(self.buf)
+        return _Stream._consume(self.buf, size)
+
+    def close(self):
+        """Close the pipe and make the producer stop."""
+        self.cancelled.set()
+        super(_Pipe, self).close()
+# class _Pipe
+
+def _decompressstream(source, target, bufsize):
+    """Decompress the data read from the _Pipe source into the _Pipe target.
+       Runs as the decompression thread of CpioFile.extractstream().
+    """
+    try:
+        stream = _Stream(None, "r", "*", source, bufsize)
+    except Exception as e:
+        target.put(e)
+    else:
+        target.feed(stream, bufsize)
+    finally:
+        source.close()
+
 class _CMPProxy(object):
 
     blocksize = 16 * 1024
@@ -528,7 +1192,8 @@ class _CMPProxy(object):
     def seek(self, pos):
         if pos < self.pos:
             self.init()
-        self.read(pos - self.pos)
+        while self.pos < pos and self.read(min(pos - self.pos, self.blocksize)):
+            pass
 
     def init(self):
         # implemented by subclasses
@@ -578,6 +1243,157 @@ class _BZ2Proxy(_CMPProxy):
 # class _BZ2Proxy
 
 
+class _FilterProxy(_CMPProxy):
+    """Proxy class for the file modes of compressions which use an
+       external filter program. Seeking backwards restarts the program.
+    """
+
+    def __init__(self, fileobj, mode, command, extfileobj=True):
+        # type:(IO[Any], str, list[str], bool) -> None
+        _CMPProxy.__init__(self, fileobj, mode)
+        self.command = command
+        self.extfileobj = extfileobj
+        self.filter = None  # type:_FilterProcess | None
+        self.init()
+
+    def init(self):
+        if self.filter is not None:
+            self.filter.close()
+        self.pos = 0
+        if self.mode == "r":
+            fd = _filefd(self.fileobj)
+            if fd is not None:
+                # The program reads from the file descriptor directly,
+                # and the file object might not know its real position.
+                os.lseek(fd, 0, os.SEEK_SET)
+            else:
+                self.fileobj.seek(0)
+        self.filter = _FilterProcess(self.command, self.mode, self.fileobj)
+
+    def read(self, size):
+        buf = cast(_FilterProcess, self.filter).read(size)
+        self.pos += len(buf)
+        return buf
+
+    def write(self, data):
+        self.pos += len(data)
+        cast(_FilterProcess, self.filter).write(data)
+
+    def close(self):
+        cast(_FilterProcess, self.filter).close()
+        if not self.extfileobj:
+            self.fileobj.close()
+# class _FilterProxy
+
+
+class _GzipIndexProxy(_CMPProxy):
+    """Proxy class for the "r:gz" mode with an index of checkpoints for
+       random access: After every `spacing` bytes of output, a copy of the
+       decompressor is saved with the offset of its next input, and seek()
+       resumes decompression from the nearest checkpoint before the target
+       instead of from the start. The start of each gzip member is also a
+       checkpoint, which needs no saved decompressor and can be persisted.
+    """
+
+    def __init__(self, fileobj, spacing, extfileobj=True):
+        # type:(IO[Any], int, bool) -> None
+        _CMPProxy.__init__(self, fileobj, "r")
+        self.spacing = spacing
+        self.extfileobj = extfileobj
+        self.points = [(0, 0, None)]    # (offset, raw offset, decompressor)
+        self.offsets = [0]              # the offsets of points, for bisect
+        self.init()
+
+    def init(self):
+        self._restore(self.points[0])
+
+    def _restore(self, point):
+        """Continue decompressing from the checkpoint point."""
+        self.pos, self.rawpos, cmpobj = point
+        self.end = self.pos     # offset of the end of the decompressed data
+        self.cmpobj = cmpobj.copy() if cmpobj else None
+        self.buf = b""
+        self.raw = b""          # input at self.rawpos not consumed by cmpobj
+        self.fileobj.seek(self.rawpos)
+
+    def _addpoint(self, offset, cmpobj):
+        if offset > self.offsets[-1]:
+            self.points.append((offset, self.rawpos, cmpobj))
+            self.offsets.append(offset)
+
+    def _decompress(self):
+        """Return the next chunk of decompressed data, b"" at its end."""
+        while True:
+            if not self.raw:
+                self.raw = self.fileobj.read(self.blocksize)
+                if not self.raw:
+                    return b""
+            if self.cmpobj is None:
+                # At the start of a gzip member. Anything else ends the data.
+                if not GZ_MAGIC.startswith(self.raw[:2]):
+                    if self.rawpos == 0:
+                        raise IOError("not a gzip file")
+                    return b""
+                self.cmpobj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            try:
+                data = self.cmpobj.decompress(self.raw, self.blocksize * 4)
+            except zlib.error as e:
+                raise ReadError("invalid compressed data: %s" % e)
+            rest = self.cmpobj.unconsumed_tail or self.cmpobj.unused_data
+            self.rawpos += len(self.raw) - len(rest)
+            self.raw = rest
+            self.end += len(data)
+            if getattr(self.cmpobj, "eof", self.cmpobj.unused_data):
+                self.cmpobj = None
+                self._addpoint(self.end, None)
+            elif self.end >= self.offsets[-1] + self.spacing:
+                self._addpoint(self.end, self.cmpobj.copy())
+            if data:
+                return data
+
+    def read(self, size):
+        b = [self.buf]
+        x = len(self.buf)
+        while x < size:
+            data = self._decompress()
+            if not data:
+                break
+            b.append(data)
+            x += len(data)
+        self.buf = b"".join(b)
+
+        buf = self.buf[:size]
+        self.buf = self.buf[size:]
+        self.pos += len(buf)
+        return buf
+
+    def seek(self, pos):
+        point = self.points[bisect_right(self.offsets, pos) - 1]
+        if pos < self.pos or point[0] > self.end:
+            self._restore(point)
+        while self.pos < pos and self.read(min(pos - self.pos, PGZ_BLOCKSIZE)):
+            pass
+
+    def getpoints(self):
+        """Return the [offset, raw offset] of the checkpoints at the start
+           of gzip members, which can be restored by setpoints().
+        """
+        return [[offset, rawpos] for offset, rawpos, cmpobj in self.points
+                if cmpobj is None]
+
+    def setpoints(self, points):
+        """Add the checkpoints returned by getpoints()."""
+        merged = dict((offset, (offset, rawpos, None)) for offset, rawpos in points)
+        merged.update((point[0], point) for point in self.points)
+        self.offsets = sorted(merged)
+        self.points = [merged[offset] for offset in self.offsets]
+
+    def close(self):
+        if not self.extfileobj:
+            self.fileobj.close()
+# class _GzipIndexProxy
+
+
 #------------------------
 # Extraction file object
 #------------------------
@@ -594,6 +1410,16 @@ class _FileInFile(object):
         self.sparse = sparse
         self.position = 0
 
+    def readable(self):
+        """Return True: the file object is open for reading.
+        """
+        return True
+
+    def seekable(self):
+        """Return True: the file object supports seek().
+        """
+        return True
+
     def tell(self):
         """Return the current file position.
         """
@@ -656,6 +1482,19 @@ class _FileInFile(object):
         #     return NUL * size
 #class _FileInFile
 
+class _MappedFileInFile(_FileInFile):
+    """A _FileInFile for archives mapped into memory: read() returns
+       memoryview slices of the mapped archive instead of copies.
+    """
+
+    def readnormal(self, size):
+        """Read operation for regular files.
+        """
+        start = self.offset + self.position
+        self.position += size
+        return self.fileobj[start:start + size]
+#class _MappedFileInFile
+
 class ExFileObject(object):
     """File-like object for reading an archive member.
        Is returned by CpioFile.extractfile().
@@ -663,10 +1502,15 @@ class ExFileObject(object):
     blocksize = 1024
 
     def __init__(self, cpiofile, cpioinfo):
-        self.fileobj = _FileInFile(cpiofile.fileobj,
-                                   cpioinfo.offset_data,
-                                   cpioinfo.size,
-                                   getattr(cpioinfo, "sparse", None))
+        if cpiofile._mapview is not None:
+            self.fileobj = _MappedFileInFile(cpiofile._mapview,
+                                             cpioinfo.offset_data,
+                                             cpioinfo.size)  # type: _FileInFile
+        else:
+            self.fileobj = _FileInFile(cpiofile.fileobj,
+                                       cpioinfo.offset_data,
+                                       cpioinfo.size,
+                                       getattr(cpioinfo, "sparse", None))
         self.name = cpioinfo.name
         self.mode = "r"
         self.closed = False
@@ -675,9 +1519,30 @@ class ExFileObject(object):
         self.position = 0
         self.buffer = b""
 
+        # For the CRC format, the data is summed up while it is read
+        # in sequence and the sum is compared at the end of the data.
+        self.check = cpioinfo.check if cpioinfo.magic == MAGIC_CRC else None
+        self.checked = 0        # the length of the data summed up
+        self.sum = 0
+
+    def _readdata(self, size=None):
+        """Read from self.fileobj and verify the checksum of the data
+           when the end of the data is reached.
+        """
+        pos = self.fileobj.position
+        data = self.fileobj.read(size)
+        if self.check is not None and pos == self.checked and data:
+            self.sum = _checksum(data, self.sum)
+            self.checked += len(data)
+            if self.checked == self.size and self.sum != self.check:
+                raise ReadError("checksum error in member %r" % self.name)
+        return data
+
     def read(self, size=None):
         """Read at most size bytes from the file. If size is not
            present or None, read all data until EOF is reached.
+           For archives opened with `usemmap`, a memoryview of the
+           mapped archive is returned unless readline() buffered data.
         """
         if self.closed:
             raise ValueError("I/O operation on closed file")
@@ -692,9 +1557,13 @@ class ExFileObject(object):
                 self.buffer = self.buffer[size:]
 
         if size is None:
-            buf += self.fileobj.read()
+            data = self._readdata()
+        else:
+            data = self._readdata(size - len(buf))
+        if buf:
+            buf += data
         else:
-            buf += self.fileobj.read(size - len(buf))
+            buf = data
 
         self.position += len(buf)
         return buf
@@ -713,7 +1582,7 @@ class ExFileObject(object):
         else:
             buffers = [self.buffer]
             while True:
-                buf = self.fileobj.read(self.blocksize)
+                buf = bytes(self._readdata(self.blocksize))
                 buffers.append(buf)
                 if not buf or b"\n" in buf:
                     self.buffer = b"".join(buffers)
@@ -797,10 +1666,17 @@ class CpioInfo(object):
        usually created internally.
     """
 
+    # Slots keep the many CpioInfo objects of large archives small:
+    __slots__ = ("magic", "ino", "mode", "uid", "gid", "nlink", "mtime", "size",
+                 "devmajor", "devminor", "rdevmajor", "rdevminor", "namesize",
+                 "check", "name", "linkname", "offset", "offset_data", "buf",
+                 "_link_path", "_link_target")
+
     def __init__(self, name=""):
         """Construct a CpioInfo object. name is the optional name
            of the member.
         """
+        self.magic = MAGIC_NEWC # format, MAGIC_CRC if check is used
         self.ino = 0            # i-node
         self.mode = S_IFREG | 0o444
         self.uid = 0            # user id
@@ -813,7 +1689,7 @@ class CpioInfo(object):
         self.rdevmajor = 0
         self.rdevminor = 0
         self.namesize = 0
-        self.check = 0
+        self.check = 0          # _checksum() of the data for MAGIC_CRC
 
         self.name = name
         self.linkname = ''
@@ -821,37 +1697,38 @@ class CpioInfo(object):
         self.offset = 0         # the cpio header starts here
         self.offset_data = 0    # the file's data starts here
 
-        self.buf = None
+        self.buf = None         # the header, see CpioFile.keepheaders
 
     def __repr__(self):
         return "<%s %r at %#x>" % (self.__class__.__name__, self.name, id(self))
 
     @classmethod
-    def frombuf(cls, buf):
+    def frombuf(cls, buf, keep=False):
         """Construct a CpioInfo object from a string buffer.
+           If keep is True, the buffer is kept as cpioinfo.buf.
         """
         cpioinfo = cls()
-        cpioinfo.buf = buf
-
-        cpioinfo.ino = int(buf[6:14], 16)
-        cpioinfo.mode = int(buf[14:22], 16)
-        cpioinfo.uid = int(buf[22:30], 16)
-        cpioinfo.gid = int(buf[30:38], 16)
-        cpioinfo.nlink = int(buf[38:46], 16)
-        cpioinfo.mtime = int(buf[46:54], 16)
-        cpioinfo.size = int(buf[54:62], 16)
-        cpioinfo.devmajor = int(buf[62:70], 16)
-        cpioinfo.devminor = int(buf[70:78], 16)
-        cpioinfo.rdevmajor = int(buf[78:86], 16)
-        cpioinfo.rdevminor = int(buf[86:94], 16)
-        cpioinfo.namesize = int(buf[94:102], 16)
-        cpioinfo.check = int(buf[102:110], 16)
+        if keep:
+            cpioinfo.buf = buf
+
+        if len(buf) < HEADERSIZE_SVR4:
+            raise ValueError("truncated header")
+        try:
+            cpioinfo.magic = MAGICS[bytes(buf[:6])]
+        except KeyError:
+            raise ValueError("invalid magic")
+        # Decode the 13 fields of 8 hex digits at once:
+        (cpioinfo.ino, cpioinfo.mode, cpioinfo.uid, cpioinfo.gid,
+         cpioinfo.nlink, cpioinfo.mtime, cpioinfo.size, cpioinfo.devmajor,
+         cpioinfo.devminor, cpioinfo.rdevmajor, cpioinfo.rdevminor,
+         cpioinfo.namesize, cpioinfo.check) = NEWC_FIELDS.unpack(
+             binascii.unhexlify(buf[6:HEADERSIZE_SVR4]))
 
         return cpioinfo
 
     def tobuf(self):
         """Return a cpio header as bytes"""
-        buf = b"%06X" % MAGIC_NEWC
+        buf = b"%06X" % self.magic
         buf += b"%08X" % self.ino
         buf += b"%08X" % self.mode
         buf += b"%08X" % self.uid
@@ -917,14 +1794,23 @@ class CpioFile(six.Iterator):
     hardlinks = True		# If true, only add content for the first
     				# hard link, else treat as regular file.
 
+    deduplicate = False         # If true, add() adds regular files with the
+                                # same content as hard links to one file.
+
     errorlevel = 0              # If 0, fatal errors only appear in debug
                                 # messages (if debug >= 0). If > 0, errors
                                 # are passed to the caller as exceptions.
 
+    keepheaders = False         # If true, keep the header of each member
+                                # in its CpioInfo.buf.
+
+    format = MAGIC_NEWC         # The format of added members: MAGIC_CRC
+                                # adds the checksum of their data.
+
     fileobject = ExFileObject
 
-    def __init__(self, name=None, mode="r", fileobj=None):
-        # type:(str | None, str, Optional[IO[bytes] | GzipFile | _Stream]) -> None
+    def __init__(self, name=None, mode="r", fileobj=None, index=False, usemmap=False):
+        # type:(str | None, str, Optional[IO[bytes] | GzipFile | _Stream], bool | str, bool) -> None
         """Open an (uncompressed) cpio archive `name'. `mode` is either `r` to
            read from an existing archive, `a` to append data to an existing
            file or `w` to create a new file overwriting an existing one. `mode`
@@ -932,6 +1818,14 @@ class CpioFile(six.Iterator):
            If `fileobj` is given, it is used for reading or writing data. If it
            can be determined, `mode` is overridden by `fileobj`'s mode.
            `fileobj` is not closed, when CpioFile is closed.
+           If `index` is True (or the path of an index file), the member index
+           written by writeindex() is used to skip reading the headers when
+           reading, and it is (re-)written on close() when writing or appending.
+           The default index file is the archive name plus INDEX_SUFFIX.
+           If `usemmap` is True and the archive is an uncompressed regular
+           file opened for reading, it is mapped into memory: Headers are
+           parsed from the mapping and the file objects returned by
+           extractfile() return memoryview slices of it from read().
         """
         if len(mode) > 1 or mode not in "raw":
             raise ValueError("mode must be 'r', 'a' or 'w'")
@@ -951,39 +1845,70 @@ class CpioFile(six.Iterator):
         self.name = None
         if name:
             self.name = os.path.abspath(name)
+        self.indexname = None   # type:str | None
+        if index and self.name:
+            self.indexname = index if isinstance(index, str) else self.name + INDEX_SUFFIX
         assert not isinstance(fileobj, io.TextIOBase)
         self.fileobj = fileobj
 
         # Init datastructures
         self.closed = False
         self.members = []       # type:list[CpioInfo]
+        self._names = {}        # type:dict[str, CpioInfo] # name -> last member
+        self._datamembers = {}  # type:dict[tuple[int, int, int], CpioInfo]
+                                # (devmajor, devminor, ino) -> data member
+        self._retain = True     # if false, __next__() does not keep members
         self._loaded = False    # flag if all members have been read
+        self._appended = None   # type:int | None # offset where appending started
+        self._closefileobj = None  # type:IO[bytes] | None # closed with the archive
         self.offset = 0        # current position in the archive file
         self.inodes = {}        # dictionary caching the inodes of
                                 # archive members already added
+        self._map = None        # type:mmap.mmap | None
+        self._mapview = None    # type:memoryview | None
+        self._fd = _filefd(fileobj) if self._mode == "r" else None
+        self._uids = {}         # type:dict[int, int] # uid -> uid set by chown()
+        self._gids = {}         # type:dict[int, int] # gid -> gid set by chown()
+        self._ownerlock = threading.Lock()  # serializes the lookups of _owner()
+        self.segment = 0        # number, offset and compression of the
+        self.segmentoffset = 0  # segment for archives yielded by
+        self.comptype = None    # opensegments()
 
         if self._mode == "r":
+            if usemmap:
+                self._mapfile()
             self.firstmember = None
-            self.firstmember = next(self)
+            try:
+                self.firstmember = next(self)
+            except Exception:
+                self.close()
+                raise
+            if self.indexname:
+                self._readindex()
 
         if self._mode == "a":
             # Move to the end of the archive,
             # before the trailer.
             self.firstmember = None
-            last_offset = 0
-            while True:
+            trailer = self._findtrailer()
+            while trailer is None:
+                # Walk the members, the trailer was not found at the end.
+                trailer = self.offset
                 try:
                     cpioinfo = next(self)
                 except ReadError:
-                    self.fileobj.seek(0)
+                    trailer = 0
                     break
-                if cpioinfo is None:
-                    self.fileobj.seek(last_offset)
-                    break
-                else:
-                    last_offset = cpioinfo.offset
+                if cpioinfo is not None:
+                    trailer = None
+            self.offset = trailer
+            self.fileobj.seek(trailer)
+            if self.members or trailer == 0:
+                self._loaded = True
+            else:
+                self._appended = trailer  # getmembers() reads them later
 
-        if self._mode in "aw":
+        if self._mode == "w":
             self._loaded = True
 
     #--------------------------------------------------------------------------
@@ -998,9 +1923,10 @@ class CpioFile(six.Iterator):
     # by adding it to the mapping in OPEN_METH.
 
     @classmethod
-    def open(cls, name=None, mode="r", fileobj=None, bufsize=20*512):
+    def open(cls, name=None, mode="r", fileobj=None, bufsize=20*512, **kwargs):
         """Open a cpio archive for reading, writing or appending. Return
-           an appropriate CpioFile class.
+           an appropriate CpioFile class. Additional keyword arguments
+           (like `index`) are passed to the CpioFile constructor.
 
            mode:
 
@@ -1020,10 +1946,26 @@ class CpioFile(six.Iterator):
            - ``r|gz``       open a gzip compressed stream of cpio blocks
            - ``r|bz2``      open a bzip2 compressed stream of cpio blocks
            - ``r|xz``       open a xz compressed stream of cpio blocks
+           - ``r|pgz``      open a gzip compressed stream of cpio blocks, whose
+                            members written by ``w|pgz`` are decompressed ahead
+                            by `threads` threads (default: the number of CPUs)
            - ``w|``         open an uncompressed stream for writing
            - ``w|gz``       open a gzip compressed stream for writing
            - ``w|bz2``      open a bzip2 compressed stream for writing
            - ``w|xz``       open a xz compressed stream for writing
+           - ``w|pgz``      open a gzip compressed stream for writing, which is
+                            compressed in blocks by `threads` threads (default:
+                            the number of CPUs) into a multi-member gzip stream
+
+           The streams accept a `compresslevel` argument for the compression.
+           ``r:gz`` accepts `checkpoints=True` for faster random access by
+           extractfile(), see gzopen().
+
+           The ``zst`` and ``lz4`` compressions and, if `external` is True,
+           also the others use the external filter programs registered in
+           FILTERS (like ``xz -T0``, ``pigz``, ``zstd -T0`` and ``lz4``),
+           which use all CPUs. Without a program present, ``zst`` and ``lz4``
+           raise CompressionError and the others use Python's modules.
         """
 
         if not name and not fileobj:
@@ -1037,18 +1979,30 @@ class CpioFile(six.Iterator):
                     raise TypeError("CpioFile.fileobj needs to be IO[bytes] or io.BytesIO()")
 
         if mode in ("r", "r:*"):
-            # Find out which *open() is appropriate for opening the file.
-            for comptype in cls.OPEN_METH:
+            # Find out which *open() is appropriate from the magic bytes.
+            extfileobj = fileobj is not None
+            if fileobj is None:
+                fileobj = bltn_open(name, "rb")
+            try:
+                saved_pos = fileobj.tell()
+                buf = fileobj.read(BLOCKSIZE)
+                fileobj.seek(saved_pos)
+                comptype = _getcomptype(buf)
+                if comptype == "cpio" and buf and buf[:6] not in MAGICS:
+                    raise ReadError("file could not be opened successfully")
                 func = getattr(cls, cls.OPEN_METH[comptype])
-                if fileobj is not None:
-                    saved_pos = fileobj.tell()
                 try:
-                    return func(name, "r", fileobj)
-                except (ReadError, CompressionError):
-                    if fileobj is not None:
-                        fileobj.seek(saved_pos)
-                    continue
-            raise ReadError("file could not be opened successfully")
+                    t = func(name, "r", fileobj, **kwargs)
+                except CompressionError:
+                    raise ReadError("file could not be opened successfully")
+            except BaseException:
+                if not extfileobj:
+                    fileobj.close()
+                raise
+            if not extfileobj:
+                # The archive is read from the file opened for the magic bytes
+                t._closefileobj = fileobj
+            return t
 
         elif ":" in mode:
             fmode, comptype = mode.split(":", 1)
@@ -1061,7 +2015,7 @@ class CpioFile(six.Iterator):
                 func = getattr(cls, cls.OPEN_METH[comptype])
             else:
                 raise CompressionError("unknown compression type %r" % comptype)
-            return func(name, fmode, fileobj)
+            return func(name, fmode, fileobj, **kwargs)
 
         elif "|" in mode:
             fmode, comptype = mode.split("|", 1)
@@ -1071,93 +2025,236 @@ class CpioFile(six.Iterator):
             if fmode not in "rw":
                 raise ValueError("mode must be 'r' or 'w'")
 
+            streamargs = dict((key, kwargs.pop(key))
+                              for key in ("threads", "compresslevel", "external")
+                              if key in kwargs)
             t = cls(name, fmode,
-                    _Stream(name, fmode, comptype, fileobj, bufsize))
+                    _Stream(name, fmode, comptype, fileobj, bufsize, **streamargs),
+                    **kwargs)
             t._extfileobj = False
             return t
 
         elif mode in "aw":
-            return cls.cpioopen(name, mode, fileobj)
+            return cls.cpioopen(name, mode, fileobj, **kwargs)
 
         raise ValueError("undiscernible mode")
 
     @classmethod
-    def cpioopen(cls, name, mode="r", fileobj=None):
-        # type:(str, str, Optional[GzipFile | IO[bytes]]) -> CpioFile
+    def cpioopen(cls, name, mode="r", fileobj=None, external=False, checkpoints=False,
+                 **kwargs):
+        # type:(str, str, Optional[GzipFile | IO[bytes]], bool, bool | int, Any) -> CpioFile
         """Open uncompressed cpio archive name for reading or writing."""
         if len(mode) > 1 or mode not in "raw":
             raise ValueError("mode must be 'r', 'a' or 'w'")
-        return cls(name, mode, fileobj)
+        return cls(name, mode, fileobj, **kwargs)
+
+    @classmethod
+    def filteropen(cls, name, mode, fileobj, comptype, **kwargs):
+        # type:(str, str, Optional[IO[bytes]], str, Any) -> CpioFile
+        """Open cpio archive name for reading or writing, compressed by an
+           external filter program for comptype. Appending is not allowed.
+        """
+        if len(mode) > 1 or mode not in "rw":
+            raise ValueError("mode must be 'r' or 'w'")
+        command = _getfilter(comptype, mode)
+        if command is None:
+            raise CompressionError("no program for %r compression found" % comptype)
+
+        extfileobj = fileobj is not None
+        if fileobj is None:
+            fileobj = bltn_open(name, mode + "b")
+        proxy = _FilterProxy(cast(IO[Any], fileobj), mode, command, extfileobj)
+        try:
+            t = cls.cpioopen(name, mode, cast(IO[Any], proxy), **kwargs)
+        except (IOError, CpioError):
+            proxy.close()
+            raise ReadError("not a %s file" % comptype)
+        t._extfileobj = False
+        return t
+
+    @classmethod
+    def zstopen(cls, name, mode="r", fileobj=None, **kwargs):
+        """Open zstd compressed cpio archive name using the zstd program."""
+        kwargs.pop("external", None)
+        return cls.filteropen(name, mode, fileobj, "zst", **kwargs)
+
+    @classmethod
+    def lz4open(cls, name, mode="r", fileobj=None, **kwargs):
+        """Open lz4 compressed cpio archive name using the lz4 program."""
+        kwargs.pop("external", None)
+        return cls.filteropen(name, mode, fileobj, "lz4", **kwargs)
 
     @classmethod
-    def gzopen(cls, name, mode="r", fileobj=None, compresslevel=9):
+    def gzopen(cls, name, mode="r", fileobj=None, compresslevel=9, external=False,
+               checkpoints=False, **kwargs):
         """Open gzip compressed cpio archive name for reading or writing.
            Appending is not allowed.
+           If `checkpoints` is True (or a spacing in bytes), reading saves
+           a checkpoint every GZ_CHECKPOINTS bytes of decompressed data, from
+           which extractfile() resumes decompression instead of starting over.
+           The checkpoints at the start of gzip members (as written by
+           ``w|pgz``) are also saved in the member index, see writeindex().
         """
         if len(mode) > 1 or mode not in "rw":
             raise ValueError("mode must be 'r' or 'w'")
+        if external and _getfilter("gz", mode):
+            return cls.filteropen(name, mode, fileobj, "gz", **kwargs)
+        gzfile = None
         try:
-            t = cls.cpioopen(name, mode, gzip.GzipFile(name, mode + "b", compresslevel, fileobj))
-        except IOError:
+            if checkpoints and mode == "r":
+                spacing = GZ_CHECKPOINTS if checkpoints is True else checkpoints
+                gzfile = _GzipIndexProxy(fileobj or bltn_open(name, "rb"),
+                                         spacing, fileobj is not None)
+            else:
+                gzfile = gzip.GzipFile(name, mode + "b", compresslevel, fileobj)
+            t = cls.cpioopen(name, mode, gzfile, **kwargs)
+        except (IOError, CpioError) as e:
+            if gzfile is not None:
+                gzfile.close()
+            if isinstance(e, CpioError):
+                raise
             raise ReadError("not a gzip file")
         t._extfileobj = False
         return t
 
     @classmethod
-    def bz2open(cls, name, mode="r", fileobj=None, compresslevel=9):
-        # type:(str, Literal["r", "w"], Optional[IO[bytes]], int) -> CpioFile
+    def bz2open(cls, name, mode="r", fileobj=None, compresslevel=9, external=False, **kwargs):
+        # type:(str, Literal["r", "w"], Optional[IO[bytes]], int, bool, Any) -> CpioFile
         """Open bzip2 compressed cpio archive name for reading or writing, no appending"""
         if len(mode) > 1 or mode not in "rw":
             raise ValueError("mode must be 'r' or 'w'.")
+        if external and _getfilter("bz2", mode):
+            return cls.filteropen(name, mode, fileobj, "bz2", **kwargs)
 
-        if fileobj is not None:
+        if fileobj is not None and sys.version_info < (3, 0):
             fileobj = cast(IO[Any], _BZ2Proxy(fileobj, mode))  # pragma: no cover
         else:
-            fileobj = bz2.BZ2File(name, mode, compresslevel=compresslevel)
+            # BZ2File reads a fileobj much faster than _BZ2Proxy
+            fileobj = bz2.BZ2File(fileobj or name, mode, compresslevel=compresslevel)
 
         try:
-            t = cls.cpioopen(name, mode, fileobj)
-        except IOError:
+            t = cls.cpioopen(name, mode, fileobj, **kwargs)
+        except (IOError, CpioError) as e:
+            if isinstance(fileobj, bz2.BZ2File):
+                fileobj.close()
+            if isinstance(e, CpioError):
+                raise
             raise ReadError("not a bzip2 file")
         t._extfileobj = False
         return t
 
     @classmethod
-    def xzopen(cls, name, mode="r", fileobj=None, compresslevel=6):
-        # type:(str, Literal["r", "w"], Optional[IO[bytes]], int) -> CpioFile
+    def xzopen(cls, name, mode="r", fileobj=None, compresslevel=6, external=False, **kwargs):
+        # type:(str, Literal["r", "w"], Optional[IO[bytes]], int, bool, Any) -> CpioFile
         """
         Open xz compressed cpio archive name for reading or writing.
         Appending is not allowed.
         """
         if len(mode) > 1 or mode not in "rw":
             raise ValueError("mode must be 'r' or 'w'.")
+        if external and _getfilter("xz", mode):
+            return cls.filteropen(name, mode, fileobj, "xz", **kwargs)
 
         try:
             import lzma
         except ImportError:
             raise CompressionError("lzma module is not available")
 
-        if fileobj is not None:
-            raise CompressionError("passing fileobj not implemented for LZMA")
-        kwargs = {}
+        lzmaargs = {}
         if sys.version_info < (3, 0):
-            kwargs["options"] = {"level": compresslevel}
+            lzmaargs["options"] = {"level": compresslevel}
         elif "w" in mode:
-            kwargs["preset"] = compresslevel
-        fileobj = lzma.LZMAFile(name, mode, **cast(Any, kwargs))
+            lzmaargs["preset"] = compresslevel
+        if fileobj is not None:
+            if sys.version_info < (3, 0):
+                raise CompressionError("passing fileobj not implemented for LZMA")
+            fileobj = lzma.LZMAFile(fileobj, mode, **cast(Any, lzmaargs))
+        else:
+            fileobj = lzma.LZMAFile(name, mode, **cast(Any, lzmaargs))
         try:
-            t = cls.cpioopen(name, mode, fileobj)
-        except IOError:
+            t = cls.cpioopen(name, mode, fileobj, **kwargs)
+        except (IOError, EOFError, lzma.LZMAError, CpioError) as e:
+            fileobj.close()
+            if isinstance(e, CpioError):
+                raise
             raise ReadError("not a XZ file")
         t._extfileobj = False
         return t
 
+    @classmethod
+    def opensegments(cls, name=None, fileobj=None, **kwargs):
+        """Yield a CpioFile for each segment of a file of concatenated cpio
+           archives, like an initrd with an uncompressed early microcode
+           archive followed by a compressed main archive. The compression
+           of each segment is detected from its magic bytes, and the NUL
+           padding between segments is skipped. Each CpioFile has the number
+           of its `segment`, its `segmentoffset` in the file and its
+           `comptype`. The file must be seekable, and a segment must not be
+           closed before the next one is requested. When `name` is given,
+           it is closed at the end of the iteration. Segments follow only
+           uncompressed and gzip compressed segments, other compressed
+           segments are assumed to extend to the end of the file.
+           Additional keyword arguments are passed to the *open() methods.
+        """
+        extfileobj = fileobj is not None
+        if fileobj is None:
+            fileobj = bltn_open(name, "rb")
+        try:
+            fileobj.seek(0, os.SEEK_END)
+            end = fileobj.tell()
+            offset = segment = 0
+            while True:
+                # Skip the padding before the next segment:
+                fileobj.seek(offset)
+                buf = b""
+                while offset < end:
+                    buf = fileobj.read(BLOCKSIZE).lstrip(NUL)
+                    if buf:
+                        break
+                    offset = min(offset + BLOCKSIZE, end)
+                if not buf:
+                    return
+                offset = fileobj.tell() - len(buf)
+                buf += fileobj.read(HEADERSIZE_SVR4)
+
+                comptype = _getcomptype(buf)
+                if comptype == "cpio" and buf[:6] not in MAGICS:
+                    raise ReadError("unknown data at offset %d" % offset)
+                segmentfile = _FileInFile(fileobj, offset, end - offset)
+                openargs = kwargs
+                if comptype == "gz":
+                    # The checkpoint proxy finds the end of the gzip data
+                    openargs = dict(kwargs, checkpoints=True)
+                func = getattr(cls, cls.OPEN_METH[comptype])
+                archive = func(None, "r", cast(IO[bytes], segmentfile), **openargs)
+                archive.segment = segment
+                archive.segmentoffset = offset
+                archive.comptype = comptype
+                yield archive
+
+                archive.getmembers()  # Read up to the trailer
+                if comptype == "cpio":
+                    offset += archive.offset
+                elif comptype == "gz":
+                    proxy = cast(_GzipIndexProxy, archive.fileobj)
+                    while proxy.read(PGZ_BLOCKSIZE):
+                        pass
+                    offset += proxy.rawpos
+                else:
+                    return
+                segment += 1
+        finally:
+            if not extfileobj:
+                fileobj.close()
+
     # All *open() methods are registered here.
     OPEN_METH = {
         "cpio": "cpioopen",   # uncompressed cpio
         "gz":  "gzopen",    # gzip compressed cpio
         "bz2": "bz2open",   # bzip2 compressed cpio
         "xz":  "xzopen",  # xz compressed cpio
+        "zst": "zstopen",   # zstd compressed cpio (external program)
+        "lz4": "lz4open",   # lz4 compressed cpio (external program)
     }
 
     #--------------------------------------------------------------------------
@@ -1171,16 +2268,49 @@ class CpioFile(six.Iterator):
             return
 
         if self._mode in "aw":
+            if self.indexname and not self._loaded:
+                self._load()  # The index lists the members appended to as well
             trailer = CpioInfo(TRAILER_NAME)
+            trailer.magic = self.format
             trailer.mode = 0
             buf = trailer.tobuf()
             self.fileobj.write(buf)
             self.offset += len(buf)
 
+        if self._map is not None:
+            cast(memoryview, self._mapview).release()
+            try:
+                self._map.close()
+            except BufferError:
+                # Slices returned by ExFileObject.read() are still in use,
+                # the mapping is released when the last of them is gone.
+                pass
+            self._map = self._mapview = None
+
         if not self._extfileobj:
             self.fileobj.close()
+        elif hasattr(self.fileobj, "flush"):
+            self.fileobj.flush()
+        if self._closefileobj is not None:
+            self._closefileobj.close()
         self.closed = True
 
+        if self._mode in "aw" and self.indexname:
+            self._writeindex(self.indexname)
+
+    def writeindex(self, path=None):
+        """Write the member index of the archive to the file `path`, which
+           defaults to the archive name plus INDEX_SUFFIX. Opening the archive
+           with `index=True` uses it to skip reading the member headers as long
+           as the size and modification time of the archive are unchanged.
+        """
+        self._check("r")
+        if not self.name:
+            raise ValueError("an index can only be written for a named archive")
+        path = path or self.indexname or self.name + INDEX_SUFFIX
+        self.getmembers()
+        self._writeindex(path)
+
     def getmember(self, name):
         # type:(str | bytes) -> CpioInfo
         """Return a CpioInfo object for member `name`. If `name` can not be
@@ -1204,6 +2334,154 @@ class CpioFile(six.Iterator):
                                 # scan the whole archive.
         return self.members
 
+    def getmembertable(self):
+        # type:() -> CpioMemberTable
+        """Return the members of the archive as a CpioMemberTable, which
+           stores their name, offsets, size and mode in compact arrays.
+           Unless they were already loaded, the remaining members are read
+           without keeping CpioInfo objects for them, which saves memory for
+           archives with very many members. With a stream, this consumes
+           the remaining members.
+        """
+        self._check("r")
+        table = CpioMemberTable()
+        for cpioinfo in self.members:
+            table.append(cpioinfo)
+        if self._loaded:
+            return table
+
+        offset = self.offset
+        self.firstmember = None  # It is in self.members already
+        self._scan(table.append)
+        self._retain = False
+        try:
+            while True:
+                cpioinfo = next(self)
+                if cpioinfo is None:
+                    break
+                table.append(cpioinfo)
+        finally:
+            self._retain = True
+        if isinstance(self.fileobj, _Stream):
+            self._loaded = True
+        else:
+            self.offset = offset  # getmembers() can load the members later
+        return table
+
+    def select(self, include=None, exclude=None):
+        # type:(Any, Any) -> Iterator[CpioInfo]
+        """Iterate over the members selected by the `include` and `exclude`
+           filters. A filter is a glob pattern or a list of glob patterns
+           for the member names (a leading "/" or "./" is ignored), or a
+           function which is passed the CpioInfo object. A member is
+           selected if it matches `include` (if given) and not `exclude`.
+           The filters only look at the headers: the data of the other
+           members is skipped by seeking, or discarded while it is
+           decompressed from a stream.
+        """
+        selected = _selector(include, exclude)
+        for cpioinfo in self:
+            if selected(cpioinfo):
+                yield cpioinfo
+
+    def stream(self, include=None, exclude=None):
+        # type:(Any, Any) -> Iterator[Tuple[CpioInfo, ExFileObject | None]]
+        """Iterate over the archive in a single pass and yield a pair of
+           the CpioInfo object and a file object for the data of each member.
+           The file object is None for members without data, as returned by
+           extractfile(), and is only valid until the next pair is requested.
+           The members are not kept in the member list, so memory use does
+           not grow with the number of members. With a stream, this consumes
+           the remaining members. `include` and `exclude` restrict the pairs
+           to the members selected by them, see select().
+        """
+        self._check("r")
+        selected = _selector(include, exclude)
+        for cpioinfo in list(self.members):
+            if selected(cpioinfo):
+                yield cpioinfo, self._streamfile(cpioinfo)
+        if self._loaded:
+            return
+
+        offset = self.offset
+        self.firstmember = None  # It is in self.members already
+        try:
+            while True:
+                self._retain = False
+                try:
+                    cpioinfo = next(self)
+                finally:
+                    self._retain = True
+                if cpioinfo is None:
+                    break
+                if not selected(cpioinfo):
+                    continue
+                fileobj = self._streamfile(cpioinfo)
+                yield cpioinfo, fileobj
+                if fileobj is not None:
+                    fileobj.close()
+        finally:
+            if isinstance(self.fileobj, _Stream):
+                self._loaded = True
+            else:
+                self.offset = offset  # getmembers() can load the members later
+
+    @classmethod
+    def extractstream(cls, fileobj, path=".", bufsize=64*1024, blocks=PIPE_BLOCKS,
+                      include=None, exclude=None, **kwargs):
+        """Extract the (compressed) archive read from the file object
+           `fileobj`, like the file returned by the openAddress() method of
+           an Accessor, to `path` without a temporary copy of the archive.
+           The archive is read, decompressed and extracted by three threads,
+           which pass blocks of `bufsize` bytes through queues of up to
+           `blocks` blocks, so that downloading, decompression and writing
+           the files overlap. `include` and `exclude` select the members to
+           extract, see select(). Additional keyword arguments are passed
+           to the CpioFile constructor.
+        """
+        if not fileobj:
+            raise ValueError("nothing to open")
+        downloaded, decompressed = _Pipe(blocks), _Pipe(blocks)
+        threads = [threading.Thread(target=downloaded.feed, args=(fileobj, bufsize)),
+                   threading.Thread(target=_decompressstream,
+                                    args=(downloaded, decompressed, bufsize))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            archive = cls.open(mode="r|", fileobj=decompressed, bufsize=bufsize, **kwargs)
+            archive.extractall(path, include=include, exclude=exclude)
+            archive.close()
+        finally:
+            decompressed.close()
+            downloaded.close()
+            for thread in threads:
+                thread.join()
+
+    @classmethod
+    def extractasync(cls, fileobj, path=".", loop=None, **kwargs):
+        """Return an asyncio future for extractstream(fileobj, path, ...),
+           which runs in the default executor of the event loop `loop` (the
+           running event loop by default), so that a coroutine can await
+           the extraction while its event loop continues to run.
+        """
+        import asyncio
+        if loop is None:
+            if sys.version_info < (3, 7):
+                loop = asyncio.get_event_loop()  # pragma: no cover
+            else:
+                loop = asyncio.get_running_loop()
+        return loop.run_in_executor(
+            None, functools.partial(cls.extractstream, fileobj, path, **kwargs))
+
+    def _streamfile(self, cpioinfo):
+        """Return a file object for the data of cpioinfo for stream(),
+           or None if it is not a regular file.
+        """
+        if not cpioinfo.isreg():
+            return None
+        return self.fileobject(self, cpioinfo)
+
     def getnames(self):
         """Return the members of the archive as a list of their names. It has
            the same order as the list returned by getmembers().
@@ -1224,6 +2502,22 @@ class CpioFile(six.Iterator):
         if fileobj is not None:
             name = fileobj.name
 
+        # Use os.stat or os.lstat, depending on platform
+        # and if symlinks shall be resolved.
+        if fileobj is None:
+            if hasattr(os, "lstat") and not self.dereference:
+                statres = os.lstat(name)
+            else:
+                statres = os.stat(name)
+        else:
+            statres = os.fstat(fileobj.fileno())
+
+        return self._getcpioinfo(name, arcname, statres)
+
+    def _getcpioinfo(self, name, arcname, statres):
+        """Create a CpioInfo object for the file `name` from its stat
+           result `statres`, see getcpioinfo().
+        """
         # Building the name of the member in the archive.
         # Backward slashes are converted to forward slashes,
         # Absolute paths are turned to relative paths.
@@ -1238,16 +2532,6 @@ class CpioFile(six.Iterator):
         # information specific for the file.
         cpioinfo = CpioInfo()
 
-        # Use os.stat or os.lstat, depending on platform
-        # and if symlinks shall be resolved.
-        if fileobj is None:
-            if hasattr(os, "lstat") and not self.dereference:
-                statres = os.lstat(name)
-            else:
-                statres = os.stat(name)
-        else:
-            statres = os.fstat(fileobj.fileno())
-
         stmd = statres.st_mode
 
         # Fill the CpioInfo object with all
@@ -1300,15 +2584,45 @@ class CpioFile(six.Iterator):
                     print("link to", cpioinfo.linkname, end="")
             print()
 
-    def add(self, name, arcname=None, recursive=True):
+    def add(self, name, arcname=None, recursive=True, workers=None):
         """Add the file `name` to the archive. `name` may be any type of file
            (directory, fifo, symbolic link, etc.). If given, `arcname`
            specifies an alternative name for the file in the archive.
            Directories are added recursively by default. This can be avoided by
-           setting `recursive` to False.
+           setting `recursive` to False. The entries of directories are added
+           sorted by name.
+           If `workers` is greater than 1, a pool of that many threads opens
+           the regular files ahead of the writer and reads those up to
+           PREFETCH_SIZE bytes into memory, which hides the latency of
+           opening and reading many files e.g. over NFS.
+           If `deduplicate` is true, the regular files added by this call are
+           hashed in parallel before they are added, and files with the same
+           content are added as hard links of one inode with only one copy
+           of the data.
         """
         self._check("aw")
 
+        members = self._walk(name, arcname, recursive)
+        if self.deduplicate:
+            members = self._dedup(list(members))
+        if workers and workers > 1 and ThreadPoolExecutor is not None:
+            self._addprefetched(members, workers)
+            return
+
+        for name, cpioinfo in members:
+            # Append the cpio header and data to the archive.
+            if cpioinfo.isreg():
+                f = bltn_open(name, "rb")
+                self.addfile(cpioinfo, f)
+                f.close()
+            else:
+                self.addfile(cpioinfo)
+
+    def _walk(self, name, arcname, recursive, statres=None):
+        """Yield (name, cpioinfo) for the file `name` and, if `recursive`,
+           for the files below it in the order in which add() adds them.
+           If given, `statres` is used instead of calling getcpioinfo().
+        """
         if arcname is None:
             arcname = name
 
@@ -1323,33 +2637,114 @@ class CpioFile(six.Iterator):
             if recursive:
                 if arcname == ".":
                     arcname = ""
-                for f in os.listdir("."):
-                    self.add(f, os.path.join(arcname, f))
+                for f, entrystat in self._listdir("."):
+                    for member in self._walk(f, os.path.join(arcname, f), recursive,
+                                             entrystat):
+                        yield member
             return
 
         self._dbg(1, name)
 
         # Create a CpioInfo object from the file.
-        cpioinfo = self.getcpioinfo(name, arcname)
+        if statres is None:
+            cpioinfo = self.getcpioinfo(name, arcname)
+        else:
+            cpioinfo = self._getcpioinfo(name, arcname, statres)
 
         if cpioinfo is None:
             self._dbg(1, "cpiofile: Unsupported type %r" % name)
             return
 
-        # Append the cpio header and data to the archive.
-        if cpioinfo.isreg():
-            f = bltn_open(name, "rb")
-            self.addfile(cpioinfo, f)
-            f.close()
-
-        elif cpioinfo.isdir():
-            self.addfile(cpioinfo)
-            if recursive:
-                for f in os.listdir(name):
-                    self.add(os.path.join(name, f), os.path.join(arcname, f))
-
+        yield name, cpioinfo
+        if cpioinfo.isdir() and recursive:
+            for f, entrystat in self._listdir(name):
+                for member in self._walk(os.path.join(name, f),
+                                         os.path.join(arcname, f), recursive,
+                                         entrystat):
+                    yield member
+
+    def _listdir(self, path):
+        """Return the (name, stat result) of the entries of the directory
+           `path` sorted by name. Uses the stat results cached by os.scandir()
+           where available, else the stat results are None.
+        """
+        if not hasattr(os, "scandir"):
+            return [(f, None) for f in sorted(os.listdir(path))]  # pragma: no cover
+        entries = sorted(os.scandir(path), key=lambda entry: entry.name)
+        return [(entry.name, entry.stat(follow_symlinks=self.dereference))
+                for entry in entries]
+
+    def _addprefetched(self, members, workers):
+        """Add members while a pool of `workers` threads opens (and for
+           small files reads) the regular files ahead of the writer.
+        """
+        assert ThreadPoolExecutor is not None
+        members = iter(members)
+        pending = deque()  # type:deque[tuple[CpioInfo, Any]]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            try:
+                while True:
+                    # Keep the pool busy with the upcoming regular files.
+                    while len(pending) < 2 * workers:
+                        member = next(members, None)
+                        if member is None:
+                            break
+                        name, cpioinfo = member
+                        job = None
+                        if cpioinfo.isreg():
+                            job = executor.submit(_prefetch, name, cpioinfo.size)
+                        pending.append((cpioinfo, job))
+                    if not pending:
+                        break
+                    cpioinfo, job = pending.popleft()
+                    if job is None:
+                        self.addfile(cpioinfo)
+                        continue
+                    f = job.result()
+                    try:
+                        self.addfile(cpioinfo, f)
+                    finally:
+                        f.close()
+            finally:
+                for _, job in pending:
+                    if job is not None and job.exception() is None:
+                        job.result().close()
+
+    def _dedup(self, members):
+        """Give the regular files in members which have the same content,
+           mode, owner and modification time, the inode of the first of them
+           and an nlink count of at least 2,
+           so that addfile() adds only its data. All of them need the count,
+           as e.g. the kernel only links files with a count of 2 or more.
+           The files are hashed in a pool of threads. Return members.
+        """
+        files = [(name, cpioinfo) for name, cpioinfo in members
+                 if cpioinfo.isreg() and cpioinfo.size > 0]
+        names = [name for name, _ in files]
+        if ThreadPoolExecutor is not None and len(files) > 1:
+            with ThreadPoolExecutor(max_workers=_cpu_count()) as executor:
+                digests = list(executor.map(_filedigest, names))
         else:
-            self.addfile(cpioinfo)
+            digests = [_filedigest(name) for name in names]
+
+        # Hard links share the inode, so only files which only differ by name are merged:
+        groups = {}  # type:dict[tuple[int, int, int, int, int, bytes], list[CpioInfo]]
+        for (_, cpioinfo), digest in zip(files, digests):
+            key = (cpioinfo.size, cpioinfo.mode, cpioinfo.uid, cpioinfo.gid,
+                   int(cpioinfo.mtime), digest)
+            groups.setdefault(key, []).append(cpioinfo)
+        for group in groups.values():
+            if len(group) < 2:
+                continue
+            first = group[0]
+            self._dbg(2, "cpiofile: %d files with the content of %s" %
+                      (len(group), first.name))
+            for cpioinfo in group:
+                cpioinfo.ino = first.ino
+                cpioinfo.devmajor = first.devmajor
+                cpioinfo.devminor = first.devminor
+                cpioinfo.nlink = max(cpioinfo.nlink, len(group))
+        return members
 
     def addfile(self, cpioinfo, fileobj=None):
         """Add the CpioInfo object `cpioinfo` to the archive. If `fileobj` is
@@ -1370,13 +2765,37 @@ class CpioFile(six.Iterator):
             else:
                 self.inodes[cpioinfo.ino] = [cpioinfo.name]
 
+        cpioinfo.offset = self.offset
+        cpioinfo.magic = self.format
+        cpioinfo.check = 0
+        patchcheck = False
+        if self.format == MAGIC_CRC and fileobj is not None and cpioinfo.size > 0:
+            if _filefd(self.fileobj) is not None or isinstance(self.fileobj, io.BytesIO):
+                # Sum up the data while it is copied and write the
+                # checksum into the header afterwards.
+                patchcheck = True
+                headerpos = self.fileobj.tell()
+            else:
+                cpioinfo.check, fileobj = _prechecksum(fileobj, cpioinfo.size)
         buf = cpioinfo.tobuf()
+        if not self.keepheaders:
+            cpioinfo.buf = None
         self.fileobj.write(buf)
         self.offset += len(buf)
+        cpioinfo.offset_data = self.offset
 
         # If there's data to follow, append it.
         if fileobj is not None:
-            copyfileobj(fileobj, self.fileobj, cpioinfo.size)
+            if patchcheck:
+                cpioinfo.check = _copychecksum(fileobj, self.fileobj, cpioinfo.size)
+                end = self.fileobj.tell()
+                self.fileobj.seek(headerpos + CHECK_OFFSET)
+                self.fileobj.write(b"%08X" % cpioinfo.check)
+                self.fileobj.seek(end)
+                if self.keepheaders:
+                    cpioinfo.tobuf()
+            else:
+                copyfileobj(fileobj, self.fileobj, cpioinfo.size)
             self.offset += cpioinfo.size
 
             _, remainder = divmod(self.offset, WORDSIZE)
@@ -1385,19 +2804,31 @@ class CpioFile(six.Iterator):
                 self.fileobj.write((WORDSIZE - remainder) * NUL)
                 self.offset += (WORDSIZE - remainder)
 
-        self.members.append(cpioinfo)
+        self._addmember(cpioinfo)
 
-    def extractall(self, path=".", members=None):
+    def extractall(self, path=".", members=None, workers=None, include=None, exclude=None):
         """Extract all members from the archive to the current working
            directory and set owner, modification time and permissions on
            directories afterwards. `path` specifies a different directory
            to extract to. `members` is optional and must be a subset of the
            list returned by getmembers().
+           `include` and `exclude` restrict the extraction to the members
+           selected by them, see select().
+           If `workers` is greater than 1 and the archive is an uncompressed
+           regular file, the regular files are written by that many threads
+           in parallel. Directories are created first, links, symlinks and
+           special files are created in archive order after all regular
+           files were written.
         """
         directories = []
 
         if members is None:
-            members = self
+            members = self.select(include, exclude)
+        elif include is not None or exclude is not None:
+            members = [m for m in members if _selector(include, exclude)(m)]
+
+        if workers and workers > 1 and self._fd is not None and ThreadPoolExecutor is not None:
+            members = self._extractparallel(path, members, workers, directories)
 
         for cpioinfo in members:
             if cpioinfo.isdir():
@@ -1417,16 +2848,132 @@ class CpioFile(six.Iterator):
 
         # Set correct owner, mtime and filemode on directories.
         for cpioinfo in directories:
-            path = os.path.join(path, six.ensure_text(cpioinfo.name))
+            dirpath = os.path.join(path, six.ensure_text(cpioinfo.name))
             try:
-                self.chown(cpioinfo, path)
-                self.utime(cpioinfo, path)
-                self.chmod(cpioinfo, path)
+                self.chown(cpioinfo, dirpath)
+                self.utime(cpioinfo, dirpath)
+                self.chmod(cpioinfo, dirpath)
             except ExtractError as e:
-                if self.errorlevel > 1:
-                    raise
-                else:
-                    self._dbg(1, "cpiofile: %s" % e)
+                self._extracterror(e)
+
+    def _extractparallel(self, path, members, workers, directories):
+        """Create the directories and write the regular files of members
+           (hard links only once) using a pool of workers threads.
+           Append the directories to `directories` and return the members
+           which remain to be extracted.
+        """
+        assert ThreadPoolExecutor is not None
+        remaining = []
+        jobs = []
+        members = list(members)
+
+        for cpioinfo in members:
+            if cpioinfo.isdir():
+                try:
+                    os.makedirs(os.path.join(path, six.ensure_text(cpioinfo.name)), 0o777)
+                except EnvironmentError:
+                    pass
+                directories.append(cpioinfo)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for cpioinfo in members:
+                if cpioinfo.isdir():
+                    continue
+                if not cpioinfo.isreg():
+                    remaining.append(cpioinfo)
+                    continue
+                if cpioinfo.nlink > 1:
+                    if cpioinfo.ino in self.inodes:
+                        # Link it to the file of the inode after all are written
+                        remaining.append(cpioinfo)
+                        continue
+                    self.inodes[cpioinfo.ino] = [cpioinfo.name]
+                targetpath = os.path.normpath(
+                    os.path.join(path, six.ensure_text(cpioinfo.name)))
+                upperdirs = os.path.dirname(targetpath)
+                if upperdirs and not os.path.exists(upperdirs):
+                    try:
+                        os.makedirs(upperdirs)
+                    except EnvironmentError:
+                        pass
+                jobs.append(executor.submit(self._writefile, cpioinfo, targetpath))
+
+            for job in jobs:
+                try:
+                    job.result()
+                except (EnvironmentError, ExtractError) as e:
+                    self._extracterror(e)
+        return remaining
+
+    def _writefile(self, cpioinfo, targetpath):
+        """Write the regular file targetpath with the data of cpioinfo from
+           the uncompressed archive file and set its owner, mode and mtime.
+           Reads using positional I/O, so it can run in parallel threads.
+        """
+        self._dbg(1, cpioinfo.name)
+        datainfo = self._datamember(cpioinfo)
+        offset, size = datainfo.offset_data, datainfo.size
+        with bltn_open(targetpath, "wb") as target:
+            if datainfo.magic == MAGIC_CRC:
+                # The data has to be read to verify its checksum
+                if self._preadchecksum(datainfo, target) != datainfo.check:
+                    raise ReadError("checksum error in member %r" % cpioinfo.name)
+            else:
+                copied = _copyfd(self._fd, target.fileno(), offset, size)
+                while copied < size:
+                    buf = os.pread(self._fd, min(size - copied, 1024 * 1024), offset + copied)
+                    if not buf:
+                        raise IOError("end of file reached")
+                    target.write(buf)
+                    copied += len(buf)
+            if self._setattrs(cpioinfo, target):
+                return
+        self.chown(cpioinfo, targetpath)
+        self.chmod(cpioinfo, targetpath)
+        self.utime(cpioinfo, targetpath)
+
+    def _preadchecksum(self, cpioinfo, target=None):
+        """Read the data of cpioinfo from the uncompressed archive file using
+           positional I/O, write it to the file target (if given) and return
+           its _checksum().
+        """
+        offset, size = cpioinfo.offset_data, cpioinfo.size
+        check = copied = 0
+        while copied < size:
+            buf = os.pread(self._fd, min(size - copied, 1024 * 1024), offset + copied)
+            if not buf:
+                raise IOError("end of file reached")
+            if target is not None:
+                target.write(buf)
+            check = _checksum(buf, check)
+            copied += len(buf)
+        return check
+
+    def verify(self, workers=None):
+        # type:(int | None) -> List[CpioInfo]
+        """Verify the checksums of the members of an archive in the CRC
+           format and return the list of members whose data does not match
+           its checksum. Members in other formats are not checked.
+           If `workers` is greater than 1 and the archive is an uncompressed
+           regular file, the members are read and checked by that many
+           threads in parallel. Else, the archive is read in a single pass.
+           Extraction verifies the checksums of the extracted members as
+           well, and raises ReadError for a mismatch.
+        """
+        self._check("r")
+        if workers and workers > 1 and self._fd is not None and ThreadPoolExecutor is not None:
+            members = [m for m in self.getmembers()
+                       if m.magic == MAGIC_CRC and m.isreg() and m.size > 0]
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                checks = list(executor.map(self._preadchecksum, members))
+            return [m for m, check in zip(members, checks) if check != m.check]
+
+        bad = []
+        for cpioinfo, fileobj in self.stream():
+            if fileobj is not None and cpioinfo.magic == MAGIC_CRC and cpioinfo.size > 0:
+                if _copychecksum(fileobj.fileobj, None, cpioinfo.size) != cpioinfo.check:
+                    bad.append(cpioinfo)
+        return bad
 
     def extract(self, member, path=""):
         """Extract a member from the archive to the current working directory,
@@ -1447,19 +2994,23 @@ class CpioFile(six.Iterator):
 
         try:
             self._extract_member(cpioinfo, os.path.join(path, six.ensure_text(cpioinfo.name)))
-        except EnvironmentError as e:
-            if self.errorlevel > 0:
-                raise
-            else:
-                if e.filename is None:
-                    self._dbg(1, "cpiofile: %s" % e.strerror)
-                else:
-                    self._dbg(1, "cpiofile: %s %r" % (e.strerror, e.filename))
-        except ExtractError as e:
+        except (EnvironmentError, ExtractError) as e:
+            self._extracterror(e)
+
+    def _extracterror(self, e):
+        """Raise the exception e of an extraction if errorlevel says so,
+           else log it as debug message.
+        """
+        if isinstance(e, ExtractError):
             if self.errorlevel > 1:
-                raise
-            else:
-                self._dbg(1, "cpiofile: %s" % e)
+                raise e
+            self._dbg(1, "cpiofile: %s" % e)
+        elif self.errorlevel > 0:
+            raise e
+        elif e.filename is None:
+            self._dbg(1, "cpiofile: %s" % e.strerror)
+        else:
+            self._dbg(1, "cpiofile: %s %r" % (e.strerror, e.filename))
 
     def extractfile(self, member):
         # type:(CpioInfo | str | bytes) -> ExFileObject | None
@@ -1478,11 +3029,11 @@ class CpioFile(six.Iterator):
         else:
             cpioinfo = self.getmember(member)
 
-        if cpioinfo.isreg():
-            return self.fileobject(self, cpioinfo)
-
-        elif cpioinfo.islnk():
+        if cpioinfo.islnk():
             return self.fileobject(self, self._datamember(cpioinfo))
+
+        elif cpioinfo.isreg():
+            return self.fileobject(self, cpioinfo)
         elif cpioinfo.issym():
             if isinstance(self.fileobj, _Stream):
                 # A small but ugly workaround for the case that someone tries
@@ -1523,8 +3074,9 @@ class CpioFile(six.Iterator):
         else:
             self._dbg(1, cpioinfo.name)
 
+        attrsdone = False
         if cpioinfo.isreg():
-            self.makefile(cpioinfo, targetpath)
+            attrsdone = self.makefile(cpioinfo, targetpath)
         elif cpioinfo.isdir():
             self.makedir(cpioinfo, targetpath)
         elif cpioinfo.isfifo():
@@ -1534,8 +3086,10 @@ class CpioFile(six.Iterator):
         elif cpioinfo.issym():
             self.makesymlink(cpioinfo, targetpath)
         else:
-            self.makefile(cpioinfo, targetpath)
+            attrsdone = self.makefile(cpioinfo, targetpath)
 
+        if attrsdone:
+            return
         self.chown(cpioinfo, targetpath)
         if not cpioinfo.issym():
             self.chmod(cpioinfo, targetpath)
@@ -1556,7 +3110,8 @@ class CpioFile(six.Iterator):
                 raise
 
     def makefile(self, cpioinfo, targetpath):
-        """Make a file called targetpath.
+        """Make a file called targetpath. Return True if its owner, mode
+           and mtime were set as well.
         """
         extractinfo = None
         if cpioinfo.nlink == 1:
@@ -1574,11 +3129,17 @@ class CpioFile(six.Iterator):
         self.inodes[cpioinfo.ino].append(cpioinfo.name)
 
         if extractinfo:
-            source = self.extractfile(extractinfo)
-            target = bltn_open(targetpath, "wb")
-            copyfileobj(source, target)
-            cast(ExFileObject, source).close()
-            target.close()
+            source = cast(ExFileObject, self.extractfile(extractinfo))
+            with bltn_open(targetpath, "wb") as target:
+                if self._fd is not None and extractinfo.magic != MAGIC_CRC:
+                    # Uncompressed archive file: Let the kernel copy the data.
+                    copied = _copyfd(self._fd, target.fileno(),
+                                     extractinfo.offset_data, extractinfo.size)
+                    source.seek(copied)
+                copyfileobj(source, target)
+                source.close()
+                return self._setattrs(cpioinfo, target)
+        return False
 
     def makefifo(self, cpioinfo, targetpath):
         """Make a fifo called targetpath.
@@ -1633,21 +3194,54 @@ class CpioFile(six.Iterator):
                 except EnvironmentError:
                     raise IOError("link could not be created")
 
+    def _owner(self, cpioinfo):
+        """Return the (uid, gid) to set as owner of cpioinfo: its ids if they
+           exist on this system, else the ids of the process. The lookups are
+           cached per uid and per gid, as they can be slow with network name
+           services, and made by one thread at a time.
+        """
+        with self._ownerlock:
+            u = self._uids.get(cpioinfo.uid)
+            if u is None:
+                try:
+                    u = PWD.getpwuid(cpioinfo.uid)[2]
+                except KeyError:
+                    u = os.getuid()
+                self._uids[cpioinfo.uid] = u
+            g = self._gids.get(cpioinfo.gid)
+            if g is None:
+                try:
+                    g = GRP.getgrgid(cpioinfo.gid)[2]
+                except KeyError:
+                    g = os.getgid()
+                self._gids[cpioinfo.gid] = g
+        return u, g
+
+    def _setattrs(self, cpioinfo, target):
+        """Set the owner, mode and mtime of cpioinfo on the file object
+           target, which was opened for writing its data, using its file
+           descriptor. Return False if the system does not support this.
+        """
+        if not _UTIME_FD:
+            return False
+        target.flush()  # Later writes would change the mtime
+        fd = target.fileno()
+        self.chown(cpioinfo, fd)
+        self.chmod(cpioinfo, fd)
+        self.utime(cpioinfo, fd)
+        return True
+
     def chown(self, cpioinfo, targetpath):
         """Set owner of targetpath according to cpioinfo.
+           targetpath may also be the file descriptor of an open file.
         """
         if PWD and hasattr(os, "geteuid") and os.geteuid() == 0:
             # We have to be root to do so.
+            u, g = self._owner(cpioinfo)
             try:
-                g = GRP.getgrgid(cpioinfo.gid)[2]
-            except KeyError:
-                g = os.getgid()
-            try:
-                u = PWD.getpwuid(cpioinfo.uid)[2]
-            except KeyError:
-                u = os.getuid()
-            try:
-                if cpioinfo.issym() and hasattr(os, "lchown"):
+                if isinstance(targetpath, int):
+                    os.fchown(targetpath, u, g)
+                elif cpioinfo.issym() and hasattr(os, "lchown"):
                     os.lchown(targetpath, u, g)
                 else:
                     if sys.platform != "os2emx":
@@ -1657,15 +3251,21 @@ class CpioFile(six.Iterator):
 
     def chmod(self, cpioinfo, targetpath):
         """Set file permissions of targetpath according to cpioinfo.
+           targetpath may also be the file descriptor of an open file.
         """
         if hasattr(os, 'chmod'):
             try:
-                os.chmod(targetpath, cpioinfo.mode)
+                if isinstance(targetpath, int):
+                    os.fchmod(targetpath, cpioinfo.mode)
+                else:
+                    os.chmod(targetpath, cpioinfo.mode)
             except EnvironmentError:
                 raise ExtractError("could not change mode")
 
     def utime(self, cpioinfo, targetpath):
         """Set modification time of targetpath according to cpioinfo.
+           targetpath may also be the file descriptor of an open file,
+           if the system supports it (see _UTIME_FD).
         """
         if not hasattr(os, 'utime'):
             return
@@ -1690,16 +3290,19 @@ class CpioFile(six.Iterator):
             self.firstmember = None
             return m
 
-        # Read the next block.
-        self.fileobj.seek(self.offset)
-        buf = self.fileobj.read(HEADERSIZE_SVR4)
+        # Read the next block (from the mapping, if the archive is mapped).
+        fileobj = self.fileobj if self._map is None else self._map
+        if fileobj is self._map and self.offset > len(self._map):
+            return None     # mmap.seek() does not allow seeking past the end
+        fileobj.seek(self.offset)
+        buf = fileobj.read(HEADERSIZE_SVR4)
         if not buf:
             return None
 
         try:
-            cpioinfo = CpioInfo.frombuf(buf)
+            cpioinfo = CpioInfo.frombuf(buf, self.keepheaders)
             total_header_len = self._word(HEADERSIZE_SVR4 + cpioinfo.namesize)
-            name_buf = self.fileobj.read(total_header_len - HEADERSIZE_SVR4)
+            name_buf = fileobj.read(total_header_len - HEADERSIZE_SVR4)
             name = name_buf.rstrip(NUL)
 
             if name == TRAILER_NAME:
@@ -1714,7 +3317,7 @@ class CpioFile(six.Iterator):
             self.offset += total_header_len
 
             if cpioinfo.issym():
-                linkname_buf = self.fileobj.read(self._word(cpioinfo.size))
+                linkname_buf = fileobj.read(self._word(cpioinfo.size))
                 cpioinfo.linkname = six.ensure_text(linkname_buf.rstrip(NUL))
                 self.offset += self._word(cpioinfo.size)
                 cpioinfo.size = 0
@@ -1727,7 +3330,8 @@ class CpioFile(six.Iterator):
                                 "file: %s" % e)
             return None
 
-        self.members.append(cpioinfo)
+        if self._retain:
+            self._addmember(cpioinfo)
         return cpioinfo
 
     def proc_member(self, cpioinfo):
@@ -1752,16 +3356,32 @@ class CpioFile(six.Iterator):
             words += 1
         return words * WORDSIZE
 
+    def _addmember(self, cpioinfo):
+        """Append cpioinfo to the member list and index it by name.
+           A later member of the same name replaces the earlier one in the
+           index, so that lookups return the last occurrence.
+           The first member of an inode which has data is indexed for
+           _datamember().
+        """
+        self.members.append(cpioinfo)
+        self._names[cpioinfo.name] = cpioinfo
+        if cpioinfo.size > 0:
+            self._datamembers.setdefault(
+                (cpioinfo.devmajor, cpioinfo.devminor, cpioinfo.ino), cpioinfo)
+
     def _datamember(self, cpioinfo):
         """Find the archive member that actually has the data
            for cpioinfo.ino.
         """
         if cpioinfo.size == 0:
             # perhaps another member has the data?
-            for info in self:
-                if info.ino == cpioinfo.ino and info.size > 0:
-                    self._dbg(2, "cpiofile: found member %s" % info.name)
-                    return info
+            key = (cpioinfo.devmajor, cpioinfo.devminor, cpioinfo.ino)
+            if key not in self._datamembers and not self._loaded:
+                self._load()
+            info = self._datamembers.get(key)
+            if info is not None:
+                self._dbg(2, "cpiofile: found member %s" % info.name)
+                return info
 
         return cpioinfo
 
@@ -1772,13 +3392,12 @@ class CpioFile(six.Iterator):
         """
         # Ensure that all members have been loaded.
         members = self.getmembers()
+        encoded_name = six.ensure_str(name)
 
         if cpioinfo is None:
-            end = len(members)
-        else:
-            end = members.index(cpioinfo)
+            return self._names.get(encoded_name)
 
-        encoded_name = six.ensure_str(name)
+        end = members.index(cpioinfo)
         for i in range(end - 1, -1, -1):
             if encoded_name == members[i].name:
                 return members[i]
@@ -1788,12 +3407,213 @@ class CpioFile(six.Iterator):
         """Read through the entire archive file and look for readable
            members.
         """
+        if self._appended is not None:
+            self._loadappended(self._appended)
+            return
+        self._scan(self._addmember)
         while True:
             cpioinfo = next(self)
             if cpioinfo is None:
                 break
         self._loaded = True
 
+    def _loadappended(self, end):
+        """Read the members that the archive had before the offset `end`,
+           where appending started, and put them in front of the members
+           added since.
+        """
+        added, offset = self.members, self.offset
+        self.members, self._names, self._datamembers = [], {}, {}
+        self.offset = 0
+        try:
+            while self.offset < end and next(self) is not None:
+                pass
+        finally:
+            self.offset = offset
+            self.fileobj.seek(offset)
+        for cpioinfo in added:
+            self._addmember(cpioinfo)
+        self._appended = None
+        self._loaded = True
+
+    def _findtrailer(self):
+        """Return the offset of the trailer of the archive, searching
+           backwards from the end of the file. Return None if no valid
+           trailer followed only by padding is found.
+        """
+        try:
+            self.fileobj.seek(0, os.SEEK_END)
+            end = self.fileobj.tell()
+        except (EnvironmentError, ValueError):
+            return None
+        start = max(0, end - TRAILER_SEARCH)
+        self.fileobj.seek(start)
+        tail = self.fileobj.read(end - start)
+
+        pos = tail.rfind(TRAILER_NAME + NUL) - HEADERSIZE_SVR4
+        if pos < 0 or (start + pos) % WORDSIZE:
+            return None
+        try:
+            if tail[pos:pos + 6] not in MAGICS:
+                return None
+            cpioinfo = CpioInfo.frombuf(tail[pos:pos + HEADERSIZE_SVR4])
+        except ValueError:
+            return None
+        if cpioinfo.namesize != len(TRAILER_NAME) + 1 or \
+           tail[pos + self._word(HEADERSIZE_SVR4 + cpioinfo.namesize):].strip(NUL):
+            return None
+        self._dbg(2, "cpiofile: found the trailer at offset %d" % (start + pos))
+        return start + pos
+
+    def _scan(self, add):
+        """Read the remaining members of an uncompressed archive which is
+           mapped (see `usemmap`) or in a BytesIO directly from its buffer,
+           without the seek() and read() calls of next(), and pass them to
+           add(). Stop at the trailer or at anything else than a complete
+           newc header, which next() handles when it continues at self.offset.
+        """
+        if self._mode != "r" or six.get_unbound_function(type(self).proc_member) is not \
+           six.get_unbound_function(CpioFile.proc_member):
+            return  # A subclass handles the members, use next()
+        if self._map is not None:
+            buf = self._map         # type:Any
+        elif isinstance(self.fileobj, io.BytesIO) and hasattr(self.fileobj, "getbuffer"):
+            buf = self.fileobj.getbuffer()
+        else:
+            return
+        if self.firstmember is not None:
+            self.firstmember = None  # It was added by the constructor
+
+        # Like next(), frombuf() and proc_member(), inlined for speed:
+        new, unpack, unhexlify = CpioInfo.__new__, NEWC_FIELDS.unpack, binascii.unhexlify
+        keep = self.keepheaders
+        end = len(buf)
+        offset = self.offset
+        try:
+            while offset + HEADERSIZE_SVR4 <= end:
+                header = bytes(buf[offset:offset + HEADERSIZE_SVR4])
+                magic = MAGICS.get(header[:6])
+                if magic is None:
+                    break
+                cpioinfo = new(CpioInfo)
+                cpioinfo.magic = magic
+                (cpioinfo.ino, cpioinfo.mode, cpioinfo.uid, cpioinfo.gid,
+                 cpioinfo.nlink, cpioinfo.mtime, cpioinfo.size, cpioinfo.devmajor,
+                 cpioinfo.devminor, cpioinfo.rdevmajor, cpioinfo.rdevminor,
+                 cpioinfo.namesize, cpioinfo.check) = unpack(unhexlify(header[6:]))
+                cpioinfo.buf = header if keep else None
+                cpioinfo.linkname = ""
+
+                namestart = offset + HEADERSIZE_SVR4
+                dataoffset = (namestart + cpioinfo.namesize + WORDSIZE - 1) & -WORDSIZE
+                if dataoffset > end:
+                    break
+                name = bytes(buf[namestart:dataoffset]).rstrip(NUL)
+                if name == TRAILER_NAME:
+                    self.offset = dataoffset
+                    break
+                cpioinfo.name = six.ensure_str(name)
+                cpioinfo.offset = offset
+
+                size = (cpioinfo.size + WORDSIZE - 1) & -WORDSIZE
+                if stat.S_ISLNK(cpioinfo.mode):
+                    cpioinfo.linkname = six.ensure_text(
+                        bytes(buf[dataoffset:dataoffset + size]).rstrip(NUL))
+                    dataoffset += size
+                    cpioinfo.size = size = 0
+
+                cpioinfo.offset_data = dataoffset
+                offset = self.offset = dataoffset + size
+                add(cpioinfo)
+        except ValueError:
+            pass  # next() raises or stops like for any invalid header
+        finally:
+            if isinstance(buf, memoryview):
+                buf.release()
+
+    def _mapfile(self):
+        """Map the archive into memory if it is an uncompressed regular
+           file, for use by __next__() and extractfile().
+        """
+        if self._fd is None:
+            self._dbg(2, "cpiofile: not mapping %r, not a regular file" % self.name)
+            return
+        try:
+            self._map = mmap.mmap(self._fd, 0, access=mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError) as e:  # e.g. an empty file
+            self._dbg(2, "cpiofile: not mapping %r: %s" % (self.name, e))
+            return
+        self._mapview = memoryview(self._map)
+
+    def _indexstat(self):
+        """Return the (size, mtime) of the archive file used to check that
+           an index file still matches it.
+        """
+        statres = os.stat(self.name)
+        return statres.st_size, statres.st_mtime
+
+    def _writeindex(self, path):
+        """Write the member index of the archive to the file path.
+        """
+        size, mtime = self._indexstat()
+        index = {
+            "version": INDEX_VERSION,
+            "size": size,
+            "mtime": mtime,
+            "end": self.offset,
+            "members": [[m.name, m.offset, m.offset_data, m.size, m.mode, m.ino,
+                         m.nlink, m.uid, m.gid, int(m.mtime), m.devmajor,
+                         m.devminor, m.rdevmajor, m.rdevminor, m.linkname,
+                         m.magic, m.check]
+                        for m in self.members],
+        }
+        if isinstance(self.fileobj, _GzipIndexProxy):
+            index["checkpoints"] = self.fileobj.getpoints()
+        with bltn_open(path, "w") as indexfile:
+            json.dump(index, indexfile)
+
+    def _readindex(self):
+        """Load the members from the index file of the archive instead of
+           reading their headers. The index is ignored unless it matches the
+           size and modification time of the archive and its first member.
+           Return True if the index was used.
+        """
+        try:
+            with bltn_open(self.indexname, "r") as indexfile:
+                index = json.load(indexfile)
+            if index["version"] != INDEX_VERSION or \
+               [index["size"], index["mtime"]] != list(self._indexstat()):
+                return False
+            entries = index["members"]
+        except (EnvironmentError, ValueError, KeyError, TypeError):
+            self._dbg(2, "cpiofile: ignoring index %r" % self.indexname)
+            return False
+
+        first = self.firstmember
+        if (first is None) != (not entries) or \
+           (first is not None and [first.name, first.offset] != entries[0][:2]):
+            self._dbg(2, "cpiofile: index %r does not match" % self.indexname)
+            return False
+
+        self.members = []
+        self._names = {}
+        self._datamembers = {}
+        for entry in entries:
+            cpioinfo = CpioInfo(entry[0])
+            (cpioinfo.offset, cpioinfo.offset_data, cpioinfo.size,
+             cpioinfo.mode, cpioinfo.ino, cpioinfo.nlink, cpioinfo.uid,
+             cpioinfo.gid, cpioinfo.mtime, cpioinfo.devmajor, cpioinfo.devminor,
+             cpioinfo.rdevmajor, cpioinfo.rdevminor, cpioinfo.linkname,
+             cpioinfo.magic, cpioinfo.check) = entry[1:]
+            cpioinfo.namesize = len(six.ensure_binary(cpioinfo.name)) + 1
+            self._addmember(cpioinfo)
+        if isinstance(self.fileobj, _GzipIndexProxy):
+            self.fileobj.setpoints(index.get("checkpoints", []))
+        self.offset = index["end"]
+        self.firstmember = None
+        self._loaded = True
+        return True
+
     def _check(self, mode=None):
         """Check if CpioFile is still open, and if the operation's mode
            corresponds to CpioFile's mode.
@@ -1806,6 +3626,8 @@ class CpioFile(six.Iterator):
     def __iter__(self):
         """Provide an iterator object.
         """
+        if self._appended is not None:
+            self._load()  # Do not read past the trailer of an archive being appended to
         if self._loaded:
             return iter(self.members)
         else:
@@ -1818,6 +3640,53 @@ class CpioFile(six.Iterator):
             print(msg, file=sys.stderr)
 # class CpioFile
 
+class CpioMemberTable(object):
+    """Compact table of the members of an archive, as returned by
+       CpioFile.getmembertable(). Names, offsets, data offsets, sizes and
+       modes are stored in arrays instead of a CpioInfo object per member.
+       The names are stored NUL-separated in one bytearray.
+    """
+
+    def __init__(self):
+        self.names = bytearray(NUL)         # NUL-separated member names
+        self.nameoffsets = array("L" if array("L").itemsize >= 8 else "Q")
+        self.offsets = array(self.nameoffsets.typecode)
+        self.offsets_data = array(self.nameoffsets.typecode)
+        self.sizes = array(self.nameoffsets.typecode)
+        self.modes = array("I")
+
+    def append(self, cpioinfo):
+        """Append the member described by cpioinfo to the table."""
+        self.nameoffsets.append(len(self.names))
+        self.names += six.ensure_binary(cpioinfo.name) + NUL
+        self.offsets.append(cpioinfo.offset)
+        self.offsets_data.append(cpioinfo.offset_data)
+        self.sizes.append(cpioinfo.size)
+        self.modes.append(cpioinfo.mode)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def name(self, index):
+        """Return the name of the member at index."""
+        start = self.nameoffsets[index]
+        return six.ensure_str(bytes(self.names[start:self.names.index(NUL, start)]))
+
+    def __getitem__(self, index):
+        """Return (name, offset, offset_data, size, mode) of the member at index."""
+        return (self.name(index), self.offsets[index], self.offsets_data[index],
+                self.sizes[index], self.modes[index])
+
+    def index(self, name):
+        """Return the index of the last member called name. Raise KeyError
+           if there is no member of that name.
+        """
+        pos = self.names.rfind(NUL + six.ensure_binary(name) + NUL)
+        if pos < 0:
+            raise KeyError("filename %r not found" % name)
+        return bisect_left(self.nameoffsets, pos + 1)
+# class CpioMemberTable
+
 class CpioIter(six.Iterator):
     """Iterator Class.
 